@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the import engines of ImportBooks.
+
+Builds a library of EPUBs with their metadata and a Kindle clippings
+file with clippings from all of them, and times importing it one book
+at a time, with the pool engine and with the pipeline engine.  The
+calibre tools are replaced by scripts that sleep for as long as a
+conversion takes and write a dummy book, so that the benchmark runs
+without calibre and measures how well the engines overlap the waits
+with the rest of the work (metadata, text extraction, locating the
+clippings, writing the org file).  Each run starts from scratch, with
+empty caches.
+
+Usage: python bench/bench_import.py [books [jobs [seconds_per_conversion]]]
+"""
+
+import codecs
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+import zipfile
+
+from bench_locate import novel, clippings
+
+FAKE_CONVERT = '''#!/bin/sh
+sleep %s
+echo converted > "$2"
+'''
+
+CONTAINER = ('<container xmlns="urn:oasis:names:tc:opendocument:xmlns:'
+             'container"><rootfiles><rootfile full-path="content.opf"/>'
+             '</rootfiles></container>')
+
+OPF = u'''<package xmlns="http://www.idpf.org/2007/opf"
+ xmlns:dc="http://purl.org/dc/elements/1.1/"><metadata>
+<dc:title>%s</dc:title><dc:creator>Author Number%d</dc:creator>
+<dc:date>20%02d-01-01</dc:date>
+<dc:identifier>urn:isbn:97800000%05d</dc:identifier></metadata>
+<manifest><item id="t" href="text.html"/></manifest>
+<spine><itemref idref="t"/></spine></package>'''
+
+def write_epub(fname, title, i, text):
+    with zipfile.ZipFile(fname, 'w') as zf:
+        zf.writestr('mimetype', 'application/epub+zip')
+        zf.writestr('META-INF/container.xml', CONTAINER)
+        zf.writestr('content.opf', (OPF % (title, i, i % 20, i))
+                    .encode('utf-8'))
+        paragraphs = [u'<p>%s</p>' % p for p in text.split(u'\n\n')]
+        zf.writestr('text.html', (u'<html><body>%s</body></html>' %
+                                  u'\n'.join(paragraphs)).encode('utf-8'))
+
+def library(root, n_books, n_words, n_clips):
+    """Writes n_books EPUBs to root/books and their clippings to
+    root/clippings.txt.
+    """
+    books = os.path.join(root, 'books')
+    os.makedirs(books)
+    with codecs.open(os.path.join(root, 'clippings.txt'), 'w',
+                     encoding='utf-8') as f:
+        for i in xrange(n_books):
+            title = u'Book number %d' % i
+            text = novel(n_words, seed=i)
+            write_epub(os.path.join(books, 'book-%03d.epub' % i),
+                       title, i, text)
+            for span, clip, loc in clippings(text, n_clips, seed=i):
+                f.write(u'%s (Author Number%d)\n- Your Highlight on '
+                        u'Location %d-%d | Added on Tuesday, June 05, '
+                        u'2012, 11:43 PM\n\n%s\n==========\n' %
+                        (title, i, loc[0], loc[1], clip))
+
+def run(root, name, jobs, engine):
+    """Imports the library in root into a fresh directory, and returns
+    the wall time and the importer.
+    """
+    import orgbib.importer
+    work = os.path.join(root, name)
+    shutil.copytree(os.path.join(root, 'books'), os.path.join(work, 'books'))
+    os.makedirs(os.path.join(work, 'master'))
+    os.environ['ORGBIB_CACHE'] = os.path.join(work, 'cache')
+    cwd = os.getcwd()
+    os.chdir(work)
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        importer = orgbib.importer.ImportBooks(
+            'books', 'master', 'ref.bib', 'ref.org',
+            clips_file=os.path.join(root, 'clippings.txt'),
+            bu_clips_file=None, engine=engine)
+        start = time.time()
+        importer.convert_all(jobs)
+        return time.time() - start, importer
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+
+def main(n_books=12, jobs=4, seconds=1.0, n_words=40000, n_clips=40):
+    root = tempfile.mkdtemp()
+    try:
+        bindir = os.path.join(root, 'bin')
+        os.makedirs(bindir)
+        convert = os.path.join(bindir, 'ebook-convert')
+        with open(convert, 'w') as f:
+            f.write(FAKE_CONVERT % seconds)
+        os.chmod(convert, 0755)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['ORGBIB_CALIBRE_HELPER'] = '0'
+        library(root, n_books, n_words, n_clips)
+
+        serial, _ = run(root, 'serial', 1, 'pool')
+        pool, _ = run(root, 'pool', jobs, 'pool')
+        pipelined, importer = run(root, 'pipeline', jobs, 'pipeline')
+        org_sizes = [os.path.getsize(os.path.join(root, name, 'ref.org'))
+                     for name in ('serial', 'pool', 'pipeline')]
+    finally:
+        shutil.rmtree(root)
+
+    print '%d books, %d clippings each, %.1f s per conversion' % \
+          (n_books, n_clips, seconds)
+    print 'one at a time:        %7.2f s' % serial
+    print 'pool, %2d jobs:        %7.2f s (%.1fx)' % (jobs, pool,
+                                                     serial / pool)
+    print 'pipeline, %2d jobs:    %7.2f s (%.1fx)' % (jobs, pipelined,
+                                                     serial / pipelined)
+    print importer.last_pipeline.report()
+    if len(set(org_sizes)) != 1:
+        print '** The org files differ:', org_sizes
+
+if __name__ == '__main__':
+    main(*[f(a) for f, a in zip([int, int, float], sys.argv[1:])])
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the clipping locators used by KindleBook.
+
+Builds a novel-sized text and a few hundred clippings taken from it
+(half of them with their line breaks, whitespace or quotes changed,
+as they come in the Kindle clippings file), and times the shingle index, and the
+whole Locator with and without Kindle locations and with the
+normalized shadow of the text, against the difflib
+search over the whole book that they replaced.  The old search is
+only timed on a handful of clippings and extrapolated.
+
+Usage: python bench/bench_locate.py [words_in_book [clippings]]
+"""
+
+import codecs
+import difflib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import orgbib.locate
+import orgbib.booktext
+
+VOCABULARY = [w for w in '''the of and to a in that he was it his had with
+    for as she you her at on not be but i by from they this which all my
+    were have one been so there would what said when out up them into
+    could no him more man very then time only little like some know now
+    about should must any great your upon such can see before well down
+    made way over again night long house eyes never think after first
+    old door life face mind hand heard room light thought might came
+    still looked head nothing things left young world young voice water
+    morning across window quite together garden silence letter river
+    whispered answered remembered somewhere afterwards perhaps although
+    suddenly already always yesterday tomorrow evening shadow
+    '''.split()]
+
+def novel(n_words, seed=0):
+    rnd = random.Random(seed)
+    out, line = [], 0
+    for i in xrange(n_words):
+        ## Zipf-ish: common words are much more common.
+        word = VOCABULARY[int(len(VOCABULARY) * rnd.random() ** 2.5)]
+        out.append(word)
+        line += len(word) + 1
+        if rnd.random() < 0.06:
+            out.append('.\n\n' if rnd.random() < 0.2 else '.')
+        if line > 70:
+            out.append('\n')
+            line = 0
+        else:
+            out.append(' ')
+    return u''.join(out).replace(u' .', u'.')
+
+def clippings(text, n, seed=1):
+    rnd = random.Random(seed)
+    clips = []
+    for i in xrange(n):
+        start = rnd.randint(0, len(text) - 2000)
+        start = text.index(u' ', start) + 1
+        end = text.index(u' ', start + rnd.randint(60, 600))
+        clip = text[start:end]
+        ## Most clippings appear verbatim in the text, the rest have
+        ## their line breaks, spacing or quotes changed.
+        if i % 2 == 0:
+            clip = u' '.join(clip.split())
+            if i % 3 == 0:
+                clip = clip.replace(u'. ', u'.  ', 1)
+            if i % 5 == 0:
+                clip = u'“' + clip + u'”'
+        ## Kindle locations are roughly every 150 bytes, with drift.
+        loc = int(start / 150.0 * (1 + 0.02 * rnd.random()))
+        clips.append(((start, end), clip, (loc, loc + (end - start) / 150)))
+    return clips
+
+def main(n_words=120000, n_clips=300):
+    text = novel(n_words)
+    clips = clippings(text, n_clips)
+
+    start = time.time()
+    index = orgbib.locate.ShingleIndex(text)
+    build = time.time() - start
+    start = time.time()
+    found = 0
+    for (a, b), clip, loc in clips:
+        span = index.find(clip)
+        if span and span[0] < b and a < span[1]:
+            found += 1
+    after = time.time() - start
+
+    tmpdir = tempfile.mkdtemp()
+    txt_file = os.path.join(tmpdir, 'book.txt')
+    with codecs.open(txt_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    start = time.time()
+    shadow = orgbib.booktext.Shadow(orgbib.booktext.ensure_shadow(txt_file))
+    write_shadow = time.time() - start
+
+    def locator(clips, with_locs, shadow=None):
+        texts = [clip for _, clip, _ in clips]
+        locs = with_locs and dict((clip, loc) for _, clip, loc in clips)
+        start = time.time()
+        spans = orgbib.locate.Locator(text, shadow).find_all(texts, locs)
+        return time.time() - start, spans
+    without_locs, spans = locator(clips, False)
+    with_locs, spans = locator(clips, True)
+    few_without_locs, _ = locator(clips[:12], False)
+    few_with_locs, _ = locator(clips[:12], True)
+    with_shadow, shadow_spans = locator(clips, True, shadow)
+    few_with_shadow, _ = locator(clips[:12], True, shadow)
+    shadow.close()
+    shutil.rmtree(tmpdir)
+    found_with_locs = sum(1 for (a, b), clip, loc in clips
+                          if clip in spans and spans[clip][0] < b and
+                          a < spans[clip][1])
+
+    sample = clips[:3]
+    start = time.time()
+    for _, clip, _ in sample:
+        matcher = difflib.SequenceMatcher(None, text, clip, autojunk=False)
+        matcher.find_longest_match(0, len(text), 0, len(clip))
+    before = (time.time() - start) / len(sample) * len(clips)
+
+    print '%d characters, %d clippings' % (len(text), len(clips))
+    print 'difflib over the book: %8.2f s (extrapolated from %d)' % \
+          (before, len(sample))
+    print 'shingle index:         %8.2f s (%.2f s building the index)' % \
+          (build + after, build)
+    print 'Locator:               %8.2f s (%.2f s for 12 clippings)' % \
+          (without_locs, few_without_locs)
+    print 'Locator with locations:%8.2f s (%.2f s for 12 clippings)' % \
+          (with_locs, few_with_locs)
+    print 'Locator with shadow:   %8.2f s (%.2f s for 12 clippings, '\
+          '%.2f s writing the shadow)' % (with_shadow, few_with_shadow,
+                                          write_shadow)
+    print 'located %d of %d clippings (%d with locations, %d with shadow)' % \
+          (found, len(clips), found_with_locs,
+           sum(1 for (a, b), clip, loc in clips
+               if clip in shadow_spans and shadow_spans[clip][0] < b and
+               a < shadow_spans[clip][1]))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of orgbib.parse.parse_metadata.
+
+Compares the per-line throughput of the current header parser with the
+one it replaced (kept below as legacy_parse_metadata), over a mix of
+the header layouts Kindle has used, and checks that both agree.
+
+Usage: python bench/bench_metadata.py [number_of_lines]
+"""
+
+import collections
+import random
+import re
+import sys
+import time
+
+import orgbib.parse
+
+
+def legacy_parse_metadata(line):
+    if '- Highlight' in line or '- Your Highlight' in line:
+        kind = 'highlight'
+    elif '- Note' in line or '- Your Note' in line:
+        kind = 'note'
+    elif '- Bookmark' in line or '- Your Bookmark' in line:
+        kind = 'bookmark'
+    else:
+        return None
+    line = line.split('|')
+
+    page = None
+    m = re.search(r'[Pp]age (\d+)', line[0])
+    if m:
+        page = int(m.group(1))
+
+    loc = None
+    m = re.search(r'Loc. (\d+-?\d+)', line[-2])
+    if m:
+        loc = orgbib.parse.parse_loc(m.group(1))
+    else:
+        m = re.search(r'Location (\d+-?\d+)', line[-2])
+        if m:
+            loc = orgbib.parse.parse_loc(m.group(1))
+
+    when = None
+    if 'Added on' in line[-1]:
+        try:
+            import dateutil.parser
+            when = dateutil.parser.parse(line[-1][9:])
+        except:
+            pass
+    Meta = collections.namedtuple('Meta', 'kind page loc when')
+    return Meta(kind, page, loc, when)
+
+
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+        'Saturday', 'Sunday']
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December']
+
+def header_lines(n, seed=0):
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(n):
+        kind = rnd.choice(['Highlight', 'Highlight', 'Note', 'Bookmark'])
+        start = rnd.randint(10, 9000)
+        day, month = rnd.choice(DAYS), rnd.choice(MONTHS)
+        dom, year = rnd.randint(1, 28), rnd.randint(2010, 2016)
+        hour, minute, ampm = rnd.randint(1, 12), rnd.randint(0, 59), \
+                             rnd.choice(['AM', 'PM'])
+        layout = i % 4
+        if layout == 0:
+            lines.append('- %s Loc. %d-%d  | Added on %s, %s %02d, %d, '
+                         '%02d:%02d %s' % (kind, start, (start + 3) % 100,
+                                           day, month, dom, year, hour,
+                                           minute, ampm))
+        elif layout == 1:
+            lines.append('- %s on Page %d | Loc. %d  | Added on %s, %s %02d, '
+                         '%d, %02d:%02d %s' % (kind, start / 30, start, day,
+                                               month, dom, year, hour,
+                                               minute, ampm))
+        elif layout == 2:
+            lines.append('- Your %s on page %d | Location %d-%d | Added on '
+                         '%s, %s %d, %d %d:%02d:%02d %s' %
+                         (kind, start / 30, start, start + 4, day, month,
+                          dom, year, hour, minute, rnd.randint(0, 59), ampm))
+        else:
+            lines.append('- Your %s on Location %d-%d | Added on %s, %s %d, '
+                         '%d %d:%02d:%02d %s' %
+                         (kind, start, start + 4, day, month, dom, year,
+                          hour, minute, rnd.randint(0, 59), ampm))
+    return lines
+
+def throughput(parse, lines):
+    start = time.time()
+    for line in lines:
+        parse(line)
+    return len(lines) / (time.time() - start)
+
+def main(n=20000):
+    lines = header_lines(n)
+    for line in lines:
+        if tuple(orgbib.parse.parse_metadata(line)) != \
+               tuple(legacy_parse_metadata(line)):
+            print '** Mismatch:', line
+            return 1
+    before = throughput(legacy_parse_metadata, lines)
+    orgbib.parse._added_on_cache.clear()
+    after = throughput(orgbib.parse.parse_metadata, lines)
+    print '%d header lines' % n
+    print 'before: %10.0f lines/s' % before
+    print 'after:  %10.0f lines/s (%.1fx)' % (after, after / before)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(a) for a in sys.argv[1:]]))
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark suite of the parts of orgbib that run once per clipping,
+book or entry: parsing the clippings file, resolving book titles,
+indexing the quotes and ids of the org file, appending to the bib file,
+locating clippings in the text of a book and building bibids.
+
+The inputs are generated (see bench/synthetic.py) in a temporary
+directory.  Each benchmark is run several times and the best time is
+kept.  The results are written as JSON, by default to
+bench/results/<commit>.json, so that they can be compared with those
+of another commit with -c.
+
+Usage: python bench/bench_suite.py [options]
+
+Options:
+
+-s n,n, --sizes=n,n   Numbers of entries of the clippings files parsed
+                      (by default 1000,10000,100000; up to 1000000).
+-r n, --repeat=n      Times each benchmark is run (by default 3).
+-o fname, --output=fname  Where to write the results.
+-c fname, --compare=fname  Results to compare with, those of another
+                      commit; benchmarks more than 20% slower are
+                      marked.
+-h, --help            This help.
+"""
+
+import codecs
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+from bench_locate import novel, clippings
+
+import orgbib.parse
+import orgbib.clipper
+import orgbib.docid
+import orgbib.orgindex
+import orgbib.importer
+
+def best_of(repeat, func, setup=None):
+    """Best time of running func, after setup, repeat times.
+    """
+    times = []
+    for i in xrange(repeat):
+        arg = setup() if setup else None
+        start = time.time()
+        func(arg) if setup else func()
+        times.append(time.time() - start)
+    return min(times)
+
+def bench_parse(tmp, sizes, repeat):
+    results = {}
+    for n in sizes:
+        fname = os.path.join(tmp, 'clippings-%d.txt' % n)
+        synthetic.clippings_file(fname, n)
+        results['parse_clippings/%d' % n] = (
+            best_of(repeat, lambda: orgbib.parse.parse_clippings(fname)), n)
+    return results
+
+def bench_full_name(tmp, repeat, n=10000):
+    fname = os.path.join(tmp, 'clippings-%d.txt' % n)
+    if not os.path.exists(fname):
+        synthetic.clippings_file(fname, n)
+    kc = orgbib.parse.Clippings(fname)
+    ## Titles as they come from the metadata: without the author, and
+    ## some of them without the subtitle or in another case.
+    titles = []
+    for i in xrange(n / 50):
+        title = synthetic.title(i)
+        titles.append([title, title.split(':')[0], title.upper()][i % 3])
+    def setup():
+        kc.full_names = {}
+    def lookup(arg):
+        for title in titles:
+            kc.book_full_name(title)
+    return {'book_full_name': (best_of(repeat, lookup, setup), len(titles))}
+
+def bench_org(tmp, repeat, n_books=500):
+    """The org index as the importer uses it: built by scanning the org
+    file, loaded from its saved state, and looked up.
+    """
+    fname = os.path.join(tmp, 'ref.org')
+    index_file = os.path.join(tmp, 'org-index.pickle')
+    synthetic.org_file(fname, n_books)
+    quotes = re.findall(r'#\+begin_quote\n(.+?)\n#\+end_quote',
+                        codecs.open(fname, encoding='utf-8').read())
+    ids = [synthetic.bibid(i) for i in xrange(n_books)]
+    def remove_state():
+        if os.path.exists(index_file):
+            os.remove(index_file)
+    def build(arg):
+        orgbib.orgindex.OrgIndex(fname, index_file)
+    def load():
+        return orgbib.orgindex.OrgIndex(fname, index_file)
+    index = load()
+    def lookup():
+        for quote in quotes:
+            index.has_quote(quote)
+        for custom_id in ids:
+            index.has_id(custom_id)
+    return {'scan_org': (best_of(repeat, lambda:
+                                 orgbib.orgindex.scan_org(fname)),
+                         len(quotes)),
+            'OrgIndex/build': (best_of(repeat, build, remove_state),
+                               len(quotes)),
+            'OrgIndex/load': (best_of(repeat, load), len(quotes)),
+            'OrgIndex/lookup': (best_of(repeat, lookup),
+                                len(quotes) + len(ids))}
+
+def bench_add_to_bib(tmp, repeat, n_entries=5000, n_new=500):
+    os.environ['ORGBIB_CACHE'] = os.path.join(tmp, 'cache')
+    bibfile = os.path.join(tmp, 'ref.bib')
+    def setup():
+        synthetic.bib_file(bibfile, n_entries)
+        importer = orgbib.importer.ImportBooks(
+            tmp, tmp, bibfile, os.path.join(tmp, 'ref.org'),
+            clips_file=None, bu_clips_file=None)
+        ## Half of them are already in the file.
+        return importer, range(n_entries - n_new / 2,
+                               n_entries + n_new / 2)
+    def add(arg):
+        importer, books = arg
+        for i in books:
+            importer.add_to_bib(synthetic.bibstr(i), synthetic.bibid(i))
+    return {'add_to_bib': (best_of(repeat, add, setup), n_new)}
+
+def bench_find_clipping(tmp, repeat, n_words=120000, n_clips=300):
+    text = novel(n_words)
+    clips = [clip for span, clip, loc in clippings(text, n_clips)]
+    text_path = os.path.join(tmp, 'text')
+    os.makedirs(text_path)
+    meta = {'bibid': 'author-2000--novel', 'title': u'Novel',
+            'author': [u'Author']}
+    synthetic.text_file(os.path.join(text_path, meta['bibid'] + '.txt'),
+                        n_words)
+    def setup():
+        return orgbib.clipper.KindleBook(os.path.join(tmp, 'novel.mobi'),
+                                         text_path, clips_file=None,
+                                         bu_clips_file=None, meta=meta)
+    def find(book):
+        for clip in clips:
+            book.find_clipping(clip)
+    return {'find_clipping': (best_of(repeat, find, setup), len(clips))}
+
+def bench_bibid(repeat, n=5000):
+    def build():
+        for i in xrange(n):
+            orgbib.docid.bibid(synthetic.title(i), synthetic.author(i),
+                               2000 + i % 20)
+    return {'bibid': (best_of(repeat, build), n)}
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run(sizes, repeat):
+    tmp = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        results = {}
+        results.update(bench_parse(tmp, sizes, repeat))
+        results.update(bench_full_name(tmp, repeat))
+        results.update(bench_org(tmp, repeat))
+        ## The importer and KindleBook talk about what they do.
+        sys.stdout = open(os.devnull, 'w')
+        results.update(bench_add_to_bib(tmp, repeat))
+        results.update(bench_find_clipping(tmp, repeat))
+        sys.stdout = stdout
+        results.update(bench_bibid(repeat))
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(tmp)
+    return dict((name, {'seconds': seconds, 'items': items,
+                        'us_per_item': 1e6 * seconds / items})
+                for name, (seconds, items) in results.iteritems())
+
+def report(results, previous=None):
+    for name in sorted(results):
+        r = results[name]
+        line = '%-24s %9.3f s %8d items %10.1f us/item' % (
+            name, r['seconds'], r['items'], r['us_per_item'])
+        if previous and name in previous:
+            ratio = r['seconds'] / max(previous[name]['seconds'], 1e-9)
+            line += '  %5.2fx%s' % (ratio, '  ** slower' if ratio > 1.2
+                                    else '')
+        print line
+
+def main():
+    def help():
+        print __doc__
+
+    from getopt import getopt
+    opts, args = getopt(sys.argv[1:], 'hs:r:o:c:',
+                        ['help', 'sizes=', 'repeat=', 'output=',
+                         'compare='])
+    sizes = [1000, 10000, 100000]
+    repeat = 3
+    output = None
+    compare = None
+    for (opt, val) in opts:
+        if   opt == '-h' or opt == '--help':
+            help()
+            sys.exit(1)
+        elif opt == '-s' or opt == '--sizes':
+            sizes = [int(n) for n in val.split(',')]
+        elif opt == '-r' or opt == '--repeat':
+            repeat = int(val)
+        elif opt == '-o' or opt == '--output':
+            output = val
+        elif opt == '-c' or opt == '--compare':
+            compare = val
+
+    rev = commit()
+    if output is None:
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'results', rev + '.json')
+    results = run(sizes, repeat)
+    previous = None
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)
+        print 'Compared with', previous['commit']
+        previous = previous['results']
+    report(results, previous)
+
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump({'commit': rev, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(),
+                   'machine': platform.node(), 'repeat': repeat,
+                   'results': results}, f, indent=1, sort_keys=True)
+    print 'Results written to', output
+
+if __name__ == '__main__':
+    main()
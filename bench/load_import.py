@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load test of ImportBooks.convert_all.
+
+Builds a library of thousands of fake books, half EPUB and half MOBI,
+and a clippings file about them, and imports it with the calibre tools
+replaced by the stand-ins of orgbib.stubcalibre, which take a random
+time and fail now and then.  Reports the books imported per second,
+the percentiles of the time each book spent in each stage of the
+pipeline, and the peak memory of the importer and of the tools.
+
+Usage: python bench/load_import.py [books [jobs [engine [failure_rate]]]]
+"""
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import synthetic
+
+import orgbib.stubcalibre
+import orgbib.importer
+
+## Seconds each call to the stand-ins takes.
+LATENCIES = {'EBOOK_META': '0.01-0.05', 'EBOOK_CONVERT': '0.05-0.3'}
+
+def library(root, n_books, clips_per_book=5):
+    books = os.path.join(root, 'books')
+    os.makedirs(books)
+    for i in xrange(n_books):
+        meta = {'title': synthetic.title(i), 'author': synthetic.author(i),
+                'date': '20%02d-01-01' % (i % 100),
+                'isbn': '97800%08d' % i}
+        ext = '.epub' if i % 2 else '.mobi'
+        orgbib.stubcalibre.stub_book(
+            os.path.join(books, 'book-%05d%s' % (i, ext)), meta, 20000)
+    synthetic.clippings_file(os.path.join(root, 'clippings.txt'),
+                             n_books * clips_per_book, n_books)
+
+def percentiles(values, ps=(50, 90, 99)):
+    values = sorted(values)
+    if not values:
+        return [0.0 for p in ps]
+    return [values[int(round(p / 100.0 * (len(values) - 1)))] for p in ps]
+
+def main(n_books=2000, jobs=8, engine='pipeline', failures=0.01):
+    root = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    try:
+        os.environ['ORGBIB_CALIBRE_TOOLS'] = orgbib.stubcalibre.install(
+            os.path.join(root, 'bin'))
+        os.environ['ORGBIB_CACHE'] = os.path.join(root, 'cache')
+        os.environ['ORGBIB_STUB_FAILURES'] = str(failures)
+        for tool, latency in LATENCIES.iteritems():
+            os.environ['ORGBIB_STUB_LATENCY_' + tool] = latency
+        library(root, n_books)
+        os.makedirs(os.path.join(root, 'master'))
+        os.chdir(root)
+
+        importer = orgbib.importer.ImportBooks(
+            'books', 'master', 'ref.bib', 'ref.org',
+            clips_file='clippings.txt', bu_clips_file=None, engine=engine)
+        sys.stdout = open(os.devnull, 'w')
+        start = time.time()
+        importer.convert_all(jobs)
+        wall = time.time() - start
+        sys.stdout = stdout
+        imported = len(os.listdir('master'))
+        quotes = open('ref.org').read().count('#+begin_quote')
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tools = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        own, tools = own / 1024, tools / 1024
+    print '%d books, %d jobs, %s engine, %g%% of the tool calls failing' % \
+          (n_books, jobs, engine, 100 * failures)
+    print '%d imported, %d quotes, in %.1f s: %.1f books/s' % \
+          (imported, quotes, wall, imported / wall)
+    pipeline = importer.last_pipeline
+    if pipeline is not None:
+        print '%-6s %8s %8s %8s  (seconds per book)' % ('stage', 'p50',
+                                                       'p90', 'p99')
+        for stage in pipeline.stages:
+            print '%-6s %8.3f %8.3f %8.3f' % tuple(
+                [stage.name] + percentiles(pipeline.latencies[stage.name]))
+    print 'peak memory: %.1f MB importer, %.1f MB largest tool call' % \
+          (own / 1024.0, tools / 1024.0)
+
+if __name__ == '__main__':
+    main(*[f(a) for f, a in zip([int, int, str, float], sys.argv[1:])])
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Generators of synthetic inputs for the benchmarks: Kindle clippings
+files, org and bib files as bibimport writes them, and book texts.
+
+The clippings files mix the header layouts Kindle has used (the old
+one with 'Loc.' and the new one with 'Location', with and without
+page), start their entries with the byte order mark Kindle leaves
+around, may use \\r\\n line endings, and have notes following their
+highlights and some bookmarks.  Everything is seeded, so that the same
+arguments always give the same files.
+
+Usage: python bench/synthetic.py clippings|org|bib|text fname [n]
+"""
+
+import codecs
+import random
+import sys
+
+from bench_locate import VOCABULARY, novel
+
+BOM = '\xef\xbb\xbf'
+
+OLD_DATE = 'Tuesday, June %02d, 2012, %02d:43 PM'
+NEW_DATE = 'Saturday, August %d, 2014 %d:16:19 PM'
+
+## Header layouts, as (highlight, note, bookmark), each taking the
+## page, the location and the date.
+OLD = ('- Highlight on Page %d | Loc. %s  | Added on %s',
+       '- Note on Page %d | Loc. %s  | Added on %s',
+       '- Bookmark on Page %d | Loc. %s  | Added on %s')
+NEW = ('- Your Highlight on page %d | Location %s | Added on %s',
+       '- Your Note on page %d | Location %s | Added on %s',
+       '- Your Bookmark on page %d | Location %s | Added on %s')
+NEW_NO_PAGE = ('- Your Highlight on Location %s | Added on %s',
+               '- Your Note on Location %s | Added on %s',
+               '- Your Bookmark on Location %s | Added on %s')
+
+def title(i):
+    return u'Synthetic Book %d: A Subtitle Number %d' % (i, i % 7)
+
+def author(i):
+    return u'Author%d, Some' % i
+
+def book_name(i):
+    """Name of book i as it appears in the clippings file.
+    """
+    return u'%s (%s)' % (title(i), author(i))
+
+def sentence(rnd, n_words):
+    return u' '.join(VOCABULARY[int(len(VOCABULARY) * rnd.random() ** 2.5)]
+                     for i in xrange(n_words)).capitalize() + u'.'
+
+def iter_clippings(n, n_books=None, seed=0):
+    """Yields n (book index, kind, page, location, text) tuples, in the
+    order Kindle would have written them.
+    """
+    rnd = random.Random(seed)
+    n_books = n_books or max(1, n / 50)
+    i = 0
+    while i < n:
+        book = rnd.randrange(n_books)
+        page = rnd.randint(1, 400)
+        loc = page * 15 + rnd.randint(0, 14)
+        roll = rnd.random()
+        if roll < 0.05:
+            yield book, 2, page, str(loc), u''
+            i += 1
+            continue
+        end = loc + rnd.randint(1, 12)
+        yield (book, 0, page, '%d-%d' % (loc, end),
+               sentence(rnd, rnd.randint(8, 60)))
+        i += 1
+        if roll > 0.85 and i < n:
+            yield book, 1, page, str(end), sentence(rnd, rnd.randint(4, 20))
+            i += 1
+
+def clippings_file(fname, n, n_books=None, seed=0):
+    """Writes a clippings file with n entries about n_books books (by
+    default one book every 50 entries).
+    """
+    rnd = random.Random(seed + 1)
+    with open(fname, 'wb') as f:
+        for book, kind, page, loc, text in iter_clippings(n, n_books, seed):
+            layout = rnd.random()
+            new = layout < 0.5
+            if layout < 0.2:
+                header = NEW_NO_PAGE[kind] % (loc, NEW_DATE %
+                                              (rnd.randint(1, 31),
+                                               rnd.randint(1, 12)))
+            elif new:
+                header = NEW[kind] % (page, loc, NEW_DATE %
+                                      (rnd.randint(1, 31), rnd.randint(1, 12)))
+            else:
+                header = OLD[kind] % (page, loc, OLD_DATE %
+                                      (rnd.randint(1, 30), rnd.randint(1, 12)))
+            eol = '\r\n' if new else '\n'
+            entry = eol.join([BOM + book_name(book).encode('utf-8'), header,
+                              '', text.encode('utf-8'), '=========='])
+            f.write(entry + eol)
+
+def bibid(i):
+    return u'author%d-20%02d--synthetic-book-%d' % (i, i % 100, i)
+
+def bibstr(i):
+    """The bib entry of book i, as docid.bibstr writes it.
+    """
+    return (u'@book {%s,\n  title = {%s},\n  author = {%s},\n'
+            u'  year = {20%02d},\n  isbn = {97800%08d}\n}' %
+            (bibid(i), title(i), author(i), i % 100, i))
+
+def bib_file(fname, n):
+    with codecs.open(fname, 'w', encoding='utf-8') as f:
+        for i in xrange(n):
+            f.write(u'\n' + bibstr(i) + u'\n')
+
+def org_file(fname, n_books, clips_per_book=20, seed=0):
+    """Writes an org file with an entry for each of n_books books, with
+    clips_per_book quotes each, as KindleBook.print_clippings does.
+    """
+    rnd = random.Random(seed)
+    with codecs.open(fname, 'w', encoding='utf-8') as f:
+        f.write(u'# -*- coding: utf-8 -*-\n\n* Inbox\n\n')
+        for i in xrange(n_books):
+            f.write(u'\n** %s\n:PROPERTIES:\n:on: [2013-04-29]\n'
+                    u':Custom_ID: %s\n:author: %s\n:title: %s\n:END:\n'
+                    u'\n[[file:master/%s.mobi][Master]].\n'
+                    u'[[bib:%s][Bib entry]].\n' %
+                    (book_name(i), bibid(i), author(i), title(i),
+                     bibid(i), bibid(i)))
+            for j in xrange(clips_per_book):
+                quote = sentence(rnd, rnd.randint(8, 60))
+                f.write(u'\n*** %s\n:PROPERTIES:\n:loc: (%d, %d)\n:END:\n'
+                        u'[[file:text/%s.txt::%s][Read more]].\n'
+                        u'\n#+begin_quote\n%s\n#+end_quote\n' %
+                        (u' '.join(quote.split()[:10]), j * 20, j * 20 + 5,
+                         bibid(i), quote[:40], quote))
+
+def text_file(fname, n_words, seed=0):
+    with codecs.open(fname, 'w', encoding='utf-8') as f:
+        f.write(novel(n_words, seed))
+
+if __name__ == '__main__':
+    kind, fname = sys.argv[1:3]
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    if kind == 'clippings':
+        clippings_file(fname, n)
+    elif kind == 'org':
+        org_file(fname, n)
+    elif kind == 'bib':
+        bib_file(fname, n)
+    elif kind == 'text':
+        text_file(fname, n)
+    else:
+        print __doc__
+        sys.exit(1)
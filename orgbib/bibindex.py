@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Index of the entry keys (and ISBNs) of a BibTeX file, to check
+whether a book is already in it without reading the file again for
+every book.
+"""
+
+import re
+import codecs
+
+from orgbib.store import file_signature
+
+_ENTRY_RE = re.compile(r'\s*@\s*(\w+)\s*[{(]\s*([^,\s]+)\s*,', re.UNICODE)
+_ISBN_RE = re.compile(r'\s*isbn\s*=\s*[{"]?\s*([\dXx-]+)', re.IGNORECASE)
+
+def iter_bib_entries(lines):
+    """Scans the lines of a BibTeX file and yields an (entry type, key,
+    isbn) tuple for each entry, with isbn None if it has none.
+    @comment, @string and @preamble are skipped.
+
+    >>> list(iter_bib_entries(['@book {cialdini-2006--influence,',
+    ...                        '  title = {Influence},',
+    ...                        '  isbn = {978-0061241895}',
+    ...                        '}', '@article{a-b,', '}']))
+    [('book', 'cialdini-2006--influence', '9780061241895'), ('article', 'a-b', None)]
+    """
+    entry = None
+    for line in lines:
+        m = _ENTRY_RE.match(line)
+        if m:
+            if entry is not None:
+                yield tuple(entry)
+            entry = None
+            if m.group(1).lower() not in ('comment', 'string', 'preamble'):
+                entry = [m.group(1).lower(), m.group(2), None]
+            continue
+        m = _ISBN_RE.match(line)
+        if m and entry is not None and entry[2] is None:
+            entry[2] = m.group(1).replace('-', '').upper()
+    if entry is not None:
+        yield tuple(entry)
+
+
+class BibIndex(object):
+    """Set of the entry keys and ISBNs of a BibTeX file.  It is built
+    with a single pass over the file, kept up to date with the entries
+    appended through it, and rebuilt only if the file changes behind
+    its back.
+    """
+    def __init__(self, bibfile):
+        self.bibfile = bibfile
+        self.keys, self.isbns = set(), set()
+        self.signature = None
+        self.refresh()
+
+    def refresh(self):
+        signature = file_signature(self.bibfile)
+        if signature != self.signature:
+            self.keys, self.isbns = set(), set()
+            if signature is not None:
+                with codecs.open(self.bibfile, encoding='utf-8') as f:
+                    self.add_entries(f)
+            self.signature = signature
+
+    def add_entries(self, lines):
+        for kind, key, isbn in iter_bib_entries(lines):
+            self.keys.add(key)
+            if isbn:
+                self.isbns.add(isbn)
+
+    def __contains__(self, key):
+        self.refresh()
+        return key in self.keys
+
+    def has_isbn(self, isbn):
+        self.refresh()
+        return isbn.replace('-', '').upper() in self.isbns
+
+    def appended(self, bibstr):
+        """Records the entries in bibstr, just appended to the file.
+        """
+        self.add_entries(bibstr.splitlines())
+        self.signature = file_signature(self.bibfile)
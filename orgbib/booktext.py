@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""Normalized shadow of the text version of a book.
+
+Clippings and the text produced by ebook-convert differ in case,
+whitespace, line breaks, quotes and ligatures.  The shadow of
+text/<bibid>.txt is a normalized version of it (lower-cased,
+whitespace collapsed, punctuation unified) in which clippings, once
+normalized the same way, can be found exactly, together with a map
+from every byte of the normalized text back to the offset in the
+original text of the character it comes from.
+
+Most bytes come from the character after the one the byte before
+comes from, so the map only keeps the bytes at which that is not so
+(collapsed whitespace, multi-byte characters, ligatures), with their
+offsets; the rest are found from the last of those before them.
+
+It is kept in text/<bibid>.norm, which is laid out to be memory
+mapped: the magic string, the number n of bytes of normalized text,
+the number m of bytes in the map, the normalized text in UTF-8 padded
+to a multiple of four bytes, and then, as little-endian 32-bit
+integers, the m bytes in increasing order followed by their m
+offsets.
+"""
+
+import os
+import codecs
+import mmap
+import struct
+import array
+import sys
+import bisect
+import itertools
+
+MAGIC = 'ORGBIBN2'
+HEADER = struct.Struct('<8sII')
+
+_UNIFY = {u'‘': u"'", u'’': u"'", u'‚': u"'", u'‛': u"'",
+          u'′': u"'", u'`': u"'", u'´': u"'",
+          u'“': u'"', u'”': u'"', u'„': u'"', u'‟': u'"',
+          u'″': u'"', u'«': u'"', u'»': u'"',
+          u'‐': u'-', u'‑': u'-', u'‒': u'-', u'–': u'-',
+          u'—': u'-', u'―': u'-', u'−': u'-',
+          u'…': u'...',
+          u'ﬀ': u'ff', u'ﬁ': u'fi', u'ﬂ': u'fl',
+          u'ﬃ': u'ffi', u'ﬄ': u'ffl', u'ﬅ': u'st',
+          u'ﬆ': u'st',
+          ## Soft hyphens and zero-width characters just go away.
+          u'\u00ad': u'', u'\u200b': u'', u'\u200c': u'', u'\u200d': u'',
+          u'\ufeff': u''}
+
+def normalize(text, start=0, space=False):
+    """Normalizes text.  Returns the normalized text, the list of the
+    offsets (plus start) of the characters of text each character of
+    it comes from, and whether it ends in a space.  space tells
+    whether the text that came before ended in a space, to be able to
+    normalize long texts in pieces.
+
+    >>> normalize(u'\\u201cFine\\u201d  \\ufb01sh\\u2014\\nOK')
+    (u'"fine" fish- ok', [0, 1, 2, 3, 4, 5, 6, 8, 8, 9, 10, 11, 12, 13, 14], False)
+    """
+    out = []
+    offsets = []
+    for i, c in enumerate(text):
+        if c.isspace():
+            if not space:
+                out.append(u' ')
+                offsets.append(start + i)
+                space = True
+            continue
+        c = _UNIFY.get(c, c)
+        if c:
+            space = False
+            for u in c.lower():
+                out.append(u)
+                offsets.append(start + i)
+    return u''.join(out), offsets, space
+
+def normalize_clipping(clipping):
+    """The normalized clipping, as UTF-8, ready to be searched for in a
+    shadow.
+
+    >>> normalize_clipping(u' \\u201cSo  it goes.\\u201d ')
+    '"so it goes."'
+    """
+    return normalize(clipping)[0].strip().encode('utf-8')
+
+def write_shadow(txt_file, shadow_file, chunk_size=1 << 16):
+    """Writes the shadow of txt_file to shadow_file, reading the text in
+    chunks.
+    """
+    points, offsets = array.array('I'), array.array('I')
+    tmp = shadow_file + '.tmp'
+    with codecs.open(txt_file, encoding='utf-8') as f:
+        with open(tmp, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, 0, 0))
+            start, space = 0, False
+            n, expected = 0, None
+            chunk = f.read(chunk_size)
+            while chunk:
+                norm, char_offsets, space = normalize(chunk, start, space)
+                encoded = norm.encode('utf-8')
+                out.write(encoded)
+                if len(encoded) == len(norm):
+                    sizes = itertools.repeat(1)
+                else:
+                    sizes = (len(c.encode('utf-8')) for c in norm)
+                for offset, size in itertools.izip(char_offsets, sizes):
+                    if offset != expected:
+                        points.append(n)
+                        offsets.append(offset)
+                    ## The rest of the bytes of a multi-byte character
+                    ## come from the same one.
+                    for k in xrange(1, size):
+                        points.append(n + k)
+                        offsets.append(offset)
+                    n += size
+                    expected = offset + 1
+                start += len(chunk)
+                chunk = f.read(chunk_size)
+            out.write('\0' * (-n % 4))
+            if sys.byteorder != 'little':
+                points.byteswap()
+                offsets.byteswap()
+            points.tofile(out)
+            offsets.tofile(out)
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, n, len(points)))
+    os.rename(tmp, shadow_file)
+
+def shadow_path(txt_file):
+    return os.path.splitext(txt_file)[0] + '.norm'
+
+def ensure_shadow(txt_file):
+    """Path of the shadow of txt_file, written if it does not exist or is
+    older than the text.
+    """
+    shadow_file = shadow_path(txt_file)
+    if (not os.path.exists(shadow_file) or
+        os.path.getmtime(shadow_file) < os.path.getmtime(txt_file) or
+        open(shadow_file, 'rb').read(len(MAGIC)) != MAGIC):
+        write_shadow(txt_file, shadow_file)
+    return shadow_file
+
+
+class Shadow(object):
+    """Memory-mapped shadow of a text file.
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> txt_file = os.path.join(tmp, 'book.txt')
+    >>> with codecs.open(txt_file, 'w', encoding='utf-8') as f:
+    ...     f.write(u'The  \\ufb01rst caf\\xe9,\\nand then  the second.')
+    >>> shadow = Shadow(ensure_shadow(txt_file))
+    >>> shadow.text()
+    'the first caf\\xc3\\xa9, and then the second.'
+    >>> shadow.points
+    5
+    >>> shadow.find(u'CAF\\xc9, and'), shadow.find(u'then the')
+    ((10, 19), (20, 29))
+    >>> shadow.close(); shutil.rmtree(tmp)
+    """
+    def __init__(self, shadow_file):
+        with open(shadow_file, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, self.points = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a shadow file: ' + shadow_file)
+        self.text_start = HEADER.size
+        self.points_start = self.text_start + self.size + (-self.size % 4)
+        self.offsets_start = self.points_start + 4 * self.points
+        ## The bytes of the map, read the first time they are needed.
+        self.point_bytes = None
+
+    def text(self):
+        """The normalized text, as UTF-8.
+        """
+        return self.map[self.text_start:self.text_start + self.size]
+
+    def original_offset(self, i):
+        """Offset in the original text of the character the i-th byte of
+        the normalized text comes from.
+        """
+        if self.point_bytes is None:
+            self.point_bytes = array.array(
+                'I', self.map[self.points_start:self.offsets_start])
+            if sys.byteorder != 'little':
+                self.point_bytes.byteswap()
+        k = bisect.bisect_right(self.point_bytes, i) - 1
+        offset = struct.unpack_from('<I', self.map,
+                                    self.offsets_start + 4 * k)[0]
+        return int(offset + i - self.point_bytes[k])
+
+    def original_span(self, start, end):
+        """Span of the original text the bytes [start, end) of the
+        normalized text come from.
+        """
+        return self.original_offset(start), self.original_offset(end - 1) + 1
+
+    def find(self, clipping):
+        """(start, end) offsets in the original text of the first
+        occurrence of clipping, once normalized, or None.
+        """
+        needle = normalize_clipping(clipping)
+        if not needle:
+            return None
+        i = self.map.find(needle, self.text_start,
+                          self.text_start + self.size)
+        if i < 0:
+            return None
+        i -= self.text_start
+        return self.original_span(i, i + len(needle))
+
+    def close(self):
+        self.map.close()
+
+
+class BookText(object):
+    """The text of a UTF-8 file, memory mapped and decoded on demand.
+    It can be sliced by character offsets, like the unicode string it
+    stands for, without ever decoding all of it at once.
+
+    Character offsets are translated to byte offsets with an index of
+    the offsets at which blocks of about block bytes start, built the
+    first time it is needed.
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile(suffix='.txt')
+    >>> f.write(u'Caf\\xe9 au lait, \\xe9t\\xe9 et hiver'.encode('utf-8'))
+    >>> f.flush()
+    >>> text = BookText(f.name, block=5)
+    >>> len(text)
+    26
+    >>> text[5:17]
+    u'au lait, \\xe9t\\xe9'
+    >>> text.find(u'\\xe9t\\xe9')
+    14
+    """
+    def __init__(self, fname, block=1 << 14):
+        self.fname = fname
+        self.block = block
+        self.map = None
+        self.starts = None
+        if os.path.getsize(fname):
+            with open(fname, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _index(self):
+        """Byte and character offsets of the start of each block, and
+        of the end of the text.
+        """
+        if self.starts is None:
+            self.starts, self.chars = [0], [0]
+            size = len(self.map) if self.map is not None else 0
+            pos = chars = 0
+            while pos < size:
+                end = min(pos + self.block, size)
+                ## Do not split multi-byte characters.
+                while end < size and ord(self.map[end]) & 0xC0 == 0x80:
+                    end -= 1
+                chars += len(self.map[pos:end].decode('utf-8'))
+                pos = end
+                self.starts.append(pos)
+                self.chars.append(chars)
+        return self.starts, self.chars
+
+    def __len__(self):
+        return self._index()[1][-1]
+
+    def byte_offset(self, i):
+        starts, chars = self._index()
+        k = bisect.bisect_right(chars, i) - 1
+        if k == len(starts) - 1 or i == chars[k]:
+            return starts[k]
+        text = self.map[starts[k]:starts[k + 1]].decode('utf-8')
+        return starts[k] + len(text[:i - chars[k]].encode('utf-8'))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if stop <= start:
+                return u''
+            text = self.map[self.byte_offset(start):
+                            self.byte_offset(stop)].decode('utf-8')
+            return text[::step] if step != 1 else text
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('BookText index out of range')
+        return self[i:i + 1]
+
+    def __iter__(self):
+        starts = self._index()[0]
+        for k in xrange(len(starts) - 1):
+            for c in self.map[starts[k]:starts[k + 1]].decode('utf-8'):
+                yield c
+
+    def find(self, sub, start=0, end=None):
+        if end is None:
+            end = len(self)
+        i = self[start:end].find(sub)
+        return i + start if i >= 0 else -1
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
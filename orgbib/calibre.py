@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""Run calibre's command line tools (ebook-meta, ebook-convert) without
+paying for calibre's startup on every call.
+
+Most of the time of a call to ebook-meta goes into starting calibre.
+The first call starts a helper, a small server run by calibre-debug
+that imports the tools once and then runs them in-process for every
+request it gets through its standard input, one JSON line per
+request, answering with the exit status and the output of the tool.
+Helpers are kept alive and reused; as many are started as calls are
+made at the same time, so that the importer's workers still convert
+in parallel.
+
+If calibre-debug cannot be found, a helper dies, or ORGBIB_CALIBRE_HELPER
+is set to 0, the tools are run as plain subprocesses.  When a helper
+has been used a line reporting the time saved is printed at exit.
+
+If ORGBIB_CALIBRE_TOOLS is set to a directory the tools are taken
+from it instead, and always run as subprocesses: that is how stand-ins
+for them (see orgbib.stubcalibre) are used in testing.
+
+Calls can be given a timeout, or get it from the timeout context of
+the thread making them; a tool that runs for longer is killed, helper
+and all, and the call fails with status TIMED_OUT.
+"""
+
+import os
+import signal
+import time
+import json
+import atexit
+import threading
+import subprocess
+import contextlib
+from distutils.spawn import find_executable
+
+from orgbib.store import cache_dir
+
+SERVER = r'''
+import os, sys, json, tempfile
+
+## The protocol goes through a copy of the standard output; whatever
+## calibre prints on its own goes to /dev/null.
+proto_out = os.fdopen(os.dup(1), 'w')
+devnull = os.open(os.devnull, os.O_WRONLY)
+os.dup2(devnull, 1)
+
+def tool(name):
+    if name == 'ebook-meta':
+        from calibre.ebooks.metadata.cli import main
+    elif name == 'ebook-convert':
+        from calibre.ebooks.conversion.cli import main
+    else:
+        return None
+    return main
+
+def run(argv):
+    main = tool(argv[0])
+    if main is None:
+        return 127, ''
+    out = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(out.fileno(), 1)
+    try:
+        try:
+            status = main(argv)
+        except SystemExit as e:
+            status = e.code
+        except Exception:
+            status = 1
+        sys.stdout.flush()
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+    out.seek(0)
+    if not isinstance(status, int):
+        status = 1 if status else 0
+    return status, out.read().decode('utf-8', 'replace')
+
+proto_out.write('ready\n')
+proto_out.flush()
+for line in iter(sys.stdin.readline, ''):
+    status, output = run(json.loads(line)['argv'])
+    proto_out.write(json.dumps({'status': status, 'output': output}) + '\n')
+    proto_out.flush()
+'''
+
+def server_script():
+    """Path of the helper's script, written to the cache directory.
+    """
+    path = os.path.join(cache_dir(), 'calibre_server.py')
+    if not os.path.exists(path) or open(path).read() != SERVER:
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(SERVER)
+        os.rename(tmp, path)
+    return path
+
+TIMED_OUT = -9
+
+_local = threading.local()
+
+@contextlib.contextmanager
+def timeout(seconds):
+    """Gives the calls made by this thread inside the context a timeout
+    of seconds (None for no timeout).
+    """
+    previous = getattr(_local, 'timeout', None)
+    _local.timeout = seconds
+    try:
+        yield
+    finally:
+        _local.timeout = previous
+
+def current_timeout():
+    return getattr(_local, 'timeout', None)
+
+
+## Tools run in a process group of their own, so that whatever they
+## start can be killed with them.
+_NEW_GROUP = getattr(os, 'setsid', None)
+
+class Watchdog(object):
+    """Kills process, and its process group, if it is still running
+    after seconds.
+    """
+    def __init__(self, process, seconds):
+        self.process = process
+        self.fired = False
+        self.timer = None
+        if seconds:
+            self.timer = threading.Timer(seconds, self.kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def kill(self):
+        self.fired = True
+        try:
+            if _NEW_GROUP:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except OSError:
+            pass
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+def run_subprocess(argv, seconds=None):
+    """Exit status and output of running argv, killed after seconds.
+    Whatever it started is killed with it.
+
+    >>> run_subprocess(['sh', '-c', 'echo out; exit 3'])
+    (3, 'out\\n')
+    >>> start = time.time()
+    >>> run_subprocess(['sh', '-c', 'sleep 5; echo late'], 0.5)
+    (-9, '')
+    >>> time.time() - start < 4
+    True
+    """
+    devnull = open(os.devnull, 'w')
+    try:
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                                   stderr=devnull, preexec_fn=_NEW_GROUP)
+        watchdog = Watchdog(process, seconds)
+        output = process.communicate()[0]
+        watchdog.cancel()
+    finally:
+        devnull.close()
+    if watchdog.fired:
+        return TIMED_OUT, ''
+    return process.returncode, output
+
+
+class Helper(object):
+    """A calibre-debug process serving tool calls.
+    """
+    def __init__(self, script):
+        start = time.time()
+        devnull = open(os.devnull, 'w')
+        self.process = subprocess.Popen(['calibre-debug', '-e', script],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=devnull, close_fds=True,
+                                        preexec_fn=_NEW_GROUP)
+        devnull.close()
+        if self.process.stdout.readline().strip() != 'ready':
+            self.close()
+            raise OSError('The calibre helper did not start')
+        self.startup = time.time() - start
+
+    def run(self, argv, seconds=None):
+        """Status and output of the tool, or None if the helper had to
+        be killed because it took more than seconds.
+        """
+        watchdog = Watchdog(self.process, seconds)
+        try:
+            self.process.stdin.write(json.dumps({'argv': argv}) + '\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        finally:
+            watchdog.cancel()
+        if watchdog.fired:
+            return None
+        if not line:
+            raise IOError('The calibre helper died')
+        answer = json.loads(line)
+        return answer['status'], answer['output'].encode('utf-8')
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+
+
+class Backend(object):
+    """Runs the tools through helpers if possible, and as subprocesses
+    otherwise, and keeps the count of how long it took.
+
+    A helper that dies is dropped, and the call made as a subprocess:
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> with open(os.path.join(tmp, 'calibre-debug'), 'w') as f:
+    ...     f.write('#!/bin/sh\\necho ready\\nread line\\nexit 1\\n')
+    >>> os.chmod(os.path.join(tmp, 'calibre-debug'), 0755)
+    >>> path = os.environ['PATH']
+    >>> os.environ['PATH'] = tmp + os.pathsep + path
+    >>> b = Backend()
+    >>> b.use_helpers
+    True
+    >>> b.run(['sh', '-c', 'echo ok'])
+    (0, 'ok\\n')
+    >>> b.helpers, b.calls['subprocess'][0]
+    ([], 1)
+    >>> os.environ['PATH'] = path
+    >>> shutil.rmtree(tmp)
+
+    Without helpers, the timeout of the calling thread still applies:
+
+    >>> b = Backend(use_helpers=False)
+    >>> with timeout(0.5):
+    ...     b.run(['sh', '-c', 'sleep 5'], current_timeout())
+    (-9, '')
+    """
+    def __init__(self, use_helpers=True):
+        self.use_helpers = use_helpers and bool(
+            find_executable('calibre-debug'))
+        self.lock = threading.Lock()
+        self.idle = []
+        self.helpers = []
+        self.calls = {'helper': [0, 0.0], 'subprocess': [0, 0.0]}
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            if not self.use_helpers:
+                return None
+        try:
+            helper = Helper(server_script())
+        except (IOError, OSError):
+            self.use_helpers = False
+            return None
+        with self.lock:
+            if not self.helpers:
+                atexit.register(self.close)
+            self.helpers.append(helper)
+        return helper
+
+    def run(self, argv, seconds=None):
+        """Exit status and output of running the calibre tool in argv,
+        killing it after seconds.
+        """
+        helper = self.acquire()
+        start = time.time()
+        result = None
+        if helper is not None:
+            try:
+                result = helper.run(argv, seconds)
+                if result is None:
+                    ## Timed out; do not try again as a subprocess.
+                    result = TIMED_OUT, ''
+                    raise IOError('The calibre helper timed out')
+                with self.lock:
+                    self.idle.append(helper)
+            except (IOError, OSError, ValueError):
+                helper.close()
+                with self.lock:
+                    self.helpers.remove(helper)
+        how = 'helper'
+        if result is None:
+            how = 'subprocess'
+            start = time.time()
+            result = run_subprocess(argv, seconds)
+        with self.lock:
+            self.calls[how][0] += 1
+            self.calls[how][1] += time.time() - start
+        return result
+
+    def report(self):
+        """A line telling how much time the helpers saved, or None if
+        they have not been used.
+        """
+        calls, spent = self.calls['helper']
+        startups = [h.startup for h in self.helpers]
+        if not calls or not startups:
+            return None
+        startup = sum(startups) / len(startups)
+        saved = calls * startup - sum(startups)
+        return ('calibre helper: %d calls, %.2fs each instead of about '
+                '%.2fs, %.1fs saved' % (calls, spent / calls,
+                                        startup + spent / calls, saved))
+
+    def close(self):
+        report = self.report()
+        if report:
+            print report
+        for helper in self.helpers:
+            helper.close()
+        self.helpers, self.idle = [], []
+
+
+def tools_dir():
+    """Directory the tools are taken from instead of the path, or None.
+    """
+    return os.environ.get('ORGBIB_CALIBRE_TOOLS') or None
+
+_backend = []
+
+def backend():
+    """The Backend of the process, without helpers if
+    ORGBIB_CALIBRE_HELPER is 0 or ORGBIB_CALIBRE_TOOLS is set.
+
+    >>> saved = _backend[:]
+    >>> del _backend[:]
+    >>> os.environ['ORGBIB_CALIBRE_HELPER'] = '0'
+    >>> backend().use_helpers
+    False
+    >>> check_output(['sh', '-c', 'echo ok'])
+    'ok\\n'
+    >>> call(['sh', '-c', 'exit 2'])
+    2
+    >>> del os.environ['ORGBIB_CALIBRE_HELPER']
+    >>> _backend[:] = saved
+    """
+    if not _backend:
+        _backend.append(
+            Backend(os.environ.get('ORGBIB_CALIBRE_HELPER', '1') != '0' and
+                    not tools_dir()))
+    return _backend[0]
+
+def run(argv, seconds=None):
+    if seconds is None:
+        seconds = current_timeout()
+    if tools_dir():
+        argv = [os.path.join(tools_dir(), argv[0])] + list(argv[1:])
+    return backend().run(argv, seconds)
+
+def call(argv, seconds=None):
+    """Like subprocess.call, discarding the output.
+    """
+    return run(argv, seconds)[0]
+
+def check_output(argv, seconds=None):
+    """Like subprocess.check_output.
+    """
+    status, output = run(argv, seconds)
+    if status:
+        raise subprocess.CalledProcessError(status, argv[0], output)
+    return output
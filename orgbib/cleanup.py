@@ -4,6 +4,8 @@ By %s
 %s
 
 Ugly hack to clean up drm without too much noise and with dashified names.
+The books are decrypted in parallel, each in a directory of its own, and
+the result for each of them is reported.
 
 Usage: azwclean [options] book_file[s]
 
@@ -19,42 +21,116 @@ Options:
 __date__ = "2013-04-29"
 __author__ = "Juan Reyero, http://juanreyero.com"
 
-import sys, os, codecs
+import sys, os
+import shutil
+import tempfile
+import traceback
+import StringIO
+import multiprocessing
 import dashify
 
+_decrypt_book = []
+
+def load_dedrm(alfdir):
+    """decryptBook from k4mobidedrm, imported once per process.
+    """
+    if not _decrypt_book:
+        if alfdir and alfdir not in sys.path:
+            sys.path.append(alfdir)
+        from k4mobidedrm import decryptBook
+        _decrypt_book.append(decryptBook)
+    return _decrypt_book[0]
+
+
+class DecryptResult(object):
+    """What happened to a book: output is the name of the decrypted
+    file, None if it could not be decrypted, and log what the
+    decryption printed.
+    """
+    def __init__(self, book, output=None, error=None, log=''):
+        self.book = book
+        self.output = output
+        self.error = error
+        self.log = log
+
+    def __repr__(self):
+        if self.output:
+            return '%s -> %s' % (self.book, self.output)
+        return '** Error decrypting %s: %s' % (self.book, self.error)
+
+
+def decrypt_job(job):
+    """Decrypts a book in a temporary directory of its own, so that any
+    number of them can run at the same time.  job is a (book, serial,
+    outdir, alfdir) tuple; returns a DecryptResult.  Meant to run in a
+    worker process, whose output it captures.
+    """
+    book, serial, outdir, alfdir = job
+    if outdir and not os.path.exists(outdir):
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            pass
+    drmdir = tempfile.mkdtemp(prefix='drm-', dir=outdir or '.')
+    log = StringIO.StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = log
+    try:
+        try:
+            load_dedrm(alfdir)(book, drmdir, [], [serial], [])
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        produced = os.listdir(drmdir)
+        if not produced:
+            return DecryptResult(book, error='nothing decrypted',
+                                 log=log.getvalue())
+        cleanbook = produced[0]
+        mobi = os.path.join(outdir,
+                            dashify.dash_name(cleanbook.replace('_nodrm', '')))
+        os.rename(os.path.join(drmdir, cleanbook), mobi)
+        return DecryptResult(book, mobi, log=log.getvalue())
+    except Exception, e:
+        return DecryptResult(book, error=str(e) or e.__class__.__name__,
+                             log=log.getvalue() + traceback.format_exc())
+    finally:
+        shutil.rmtree(drmdir, ignore_errors=True)
+
+
 class Cleanup(object):
-    def __init__(self, serial, alfdir, outdir='tmp'):
+    """Decrypts books on a pool of processes, created the first time it
+    is needed, in which k4mobidedrm is imported once.
+    """
+    def __init__(self, serial, alfdir, outdir='tmp', processes=None):
         self.serial = serial
         self.alfdir = alfdir
         self.outdir = outdir
+        self.processes = processes
+        self.pool = None
+
+    def decrypt_many(self, books):
+        """Decrypts all the books in parallel and returns a DecryptResult
+        for each of them, in the same order.
+        """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        return self.pool.map(decrypt_job,
+                             [(os.path.expanduser(book), self.serial,
+                               self.outdir, self.alfdir) for book in books])
 
     def decrypt(self, book):
-        """Decrypts the book and returns the name of the output file.
+        """Decrypts the book and returns the name of the output file, or
+        None if it cannot be decrypted.
         """
-        if self.outdir and not os.path.exists(self.outdir):
-            os.makedirs(self.outdir)
-        drmdir = os.path.join(self.outdir, 'drm')
-        os.mkdir(drmdir)
-        cleanbook = None
-        mobi = None
-        try:
-            temp = sys.stdout
-            sys.stdout = codecs.open(os.devnull, 'w', encoding='utf-8')
-            if self.alfdir:
-                sys.path.append(self.alfdir)
-            from k4mobidedrm import decryptBook
-            decryptBook(os.path.expanduser(book), drmdir,
-                        [], [self.serial], [])
-            sys.stdout = temp
-            cleanbook = os.listdir(drmdir)[0]
-            mobi = os.path.join(self.outdir,
-                                dashify.dash_name(cleanbook.replace('_nodrm', '')))
-
-            os.rename(os.path.join(drmdir, cleanbook), mobi)
-        finally:
-            os.rmdir(drmdir)
+        result = self.decrypt_many([book])[0]
+        if result.output is None:
+            print result
+        return result.output
 
-        return mobi
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
 def as_main():
     import os, sys
@@ -80,8 +156,12 @@ def as_main():
         sys.exit(1)
 
     cl = Cleanup(serial, alfdir, outdir='')
-    for fname in files:
-        print cl.decrypt(fname)
+    results = cl.decrypt_many(files)
+    cl.close()
+    for result in results:
+        print result
+    if [r for r in results if r.output is None]:
+        sys.exit(1)
 
 if __name__ == '__main__':
     as_main()
@@ -46,25 +46,158 @@ __date__ = "2013-04-29"
 __author__ = "Juan Reyero, http://juanreyero.com"
 
 
-import os, codecs, sys, subprocess
+import os, codecs, sys
 import re
+import shutil
 import datetime
 import orgbib.parse
 import orgbib.docid
+import orgbib.locate
+import orgbib.booktext
+import orgbib.epubtext
+import orgbib.orgindex
+import orgbib.textstore
+import orgbib.calibre
 
-def extract_quotes(orgfile):
-    return set(re.findall(r'\#\+begin_quote\n(.+?)\n\#\+end_quote',
-                          codecs.open(orgfile,
-                                      encoding='utf-8').read(),
-                          re.DOTALL|re.IGNORECASE))
+#:Custom_ID: harford-2011---adapt
 
-def extract_ids(orgfile):
-    return set(re.findall(r':custom_id: (.+?)\n',
-                          codecs.open(orgfile,
-                                      encoding='utf-8').read(),
-                          re.DOTALL|re.IGNORECASE))
+def upcase_first(s):
+    return s[0].upper() + s[1:]
+
+def link_text(text):
+    """Search text of an org link to text: its whitespace collapsed and,
+    as brackets would end the link, its longest stretch without any.
+
+    >>> link_text(u'It was [sic] the best\\n of times')
+    u'the best of times'
+    """
+    pieces = re.split(r'[][]', u' '.join(text.split()))
+    return max(pieces, key=len).strip()
+
+def insert_in_section(lines, bibid, entries, notes=()):
+    """Adds entries, the text of *** entries, at the end of the section
+    of the org file lines whose Custom_ID is bibid, and each (quote,
+    note) of notes to the entry of its quote, unless it is there.
+    Returns the new lines, or None if there is no such section.
+
+    >>> lines = [u'** A\\n', u':PROPERTIES:\\n', u':Custom_ID: a\\n',
+    ...          u':END:\\n', u'\\n', u'*** Hi\\n', u':PROPERTIES:\\n',
+    ...          u':END:\\n', u'\\n', u'#+begin_quote\\n', u'Hi there.\\n',
+    ...          u'#+end_quote\\n', u'\\n', u'** B\\n']
+    >>> lines = insert_in_section(lines, 'a', u'\\n*** New\\n',
+    ...                           [(u'Hi there.', u'A note.')])
+    >>> print u''.join(lines),
+    ** A
+    :PROPERTIES:
+    :Custom_ID: a
+    :END:
+    <BLANKLINE>
+    *** Hi
+    :PROPERTIES:
+    :END:
+    A note.
+    <BLANKLINE>
+    #+begin_quote
+    Hi there.
+    #+end_quote
+    <BLANKLINE>
+    *** New
+    <BLANKLINE>
+    ** B
+    >>> insert_in_section(lines, 'a', u'', [(u'Hi there.', u'A note.')]) \\
+    ...     == lines
+    True
+    >>> insert_in_section(lines, 'b', u'') is None
+    True
+    """
+    custom_id = u':custom_id: %s' % bibid.lower()
+    found = [i for i, line in enumerate(lines)
+             if line.strip().lower() == custom_id]
+    if not found:
+        return None
+    end = found[0] + 1
+    while end < len(lines) and not re.match(r'\*{1,2} ', lines[end]):
+        end += 1
+    while end > found[0] + 1 and not lines[end - 1].strip():
+        end -= 1
+
+    notes = dict((orgbib.orgindex.quote_key(quote), note)
+                 for quote, note in notes)
+    inserts = []
+    heading = props_end = quote = None
+    for i in xrange(found[0] + 1, end):
+        lower = lines[i].strip().lower()
+        if quote is not None:
+            if not lower.startswith(u'#+end_quote'):
+                quote.append(lines[i])
+                continue
+            note = notes.get(orgbib.orgindex.quote_key(u''.join(quote)))
+            entry = u' '.join(u''.join(lines[heading:i]).split())
+            if note and not u' '.join(note.split()) in entry:
+                inserts.append((props_end, note))
+            quote = None
+        elif lines[i].startswith(u'*** '):
+            heading = props_end = i + 1
+        elif lower.startswith(u':end:') and props_end == heading:
+            props_end = i + 1
+        elif lower.startswith(u'#+begin_quote') and heading is not None:
+            quote = []
+
+    lines = list(lines)
+    if lines[end - 1] and not lines[end - 1].endswith(u'\n'):
+        lines[end - 1] += u'\n'
+    if entries:
+        lines.insert(end, entries)
+    for pos, note in reversed(inserts):
+        lines.insert(pos, note + (u'\n' if not lines[pos].strip()
+                                  else u'\n\n'))
+    return lines
+
+def convert_text(book_file, txt_file):
+    """Writes the text of book_file to txt_file.  EPUBs are converted
+    directly (see orgbib.epubtext); the rest, and the EPUBs that cannot
+    be, with calibre's ebook-convert.  Returns whether it succeeded.
+    """
+    if os.path.splitext(book_file)[1] == '.epub' and \
+           orgbib.epubtext.epub_to_text(book_file, txt_file):
+        return True
+    try:
+        if orgbib.calibre.call(['ebook-convert', book_file, txt_file]):
+            print "** Error converting", book_file, \
+              "to text (maybe DRMed book?)"
+            return False
+        return True
+    except:
+        print "** Error converting", book_file, \
+          "to text (maybe calibre's ebook-convert not installed?)"
+        return False
+
+def text_version(book_file, txtbook_file):
+    """Produces the text version of book_file, unless it already
+    exists or the book is a PDF.  It is taken from the store of
+    converted texts (see orgbib.textstore) if the same book has been
+    converted before, under whatever name.
+    """
+    if os.path.exists(txtbook_file) or \
+           os.path.splitext(book_file)[1] == '.pdf':
+        return
+    text_path = os.path.dirname(txtbook_file)
+    if text_path and not os.path.exists(text_path):
+        try:
+            os.makedirs(text_path)
+        except OSError:
+            ## Somebody else created it meanwhile.
+            pass
+    try:
+        done = orgbib.textstore.shared_store().text_for(book_file,
+                                                        txtbook_file,
+                                                        convert_text)
+    except (IOError, OSError):
+        ## The store cannot be used, convert in place.
+        done = convert_text(book_file, txtbook_file)
+    if done:
+        print ' ->', txtbook_file
 
-#:Custom_ID: harford-2011---adapt
 
 class KindleBook(object):
     """Associated to a mobi book file, it knows how to extract the
@@ -86,29 +219,22 @@ class KindleBook(object):
         self.title = self.meta['title']
 
         self.txtbook_file = os.path.join(text_path, self.bibid + '.txt')
-        if not os.path.exists(self.txtbook_file) and \
-               os.path.splitext(book_file)[1] != '.pdf':
-            if not os.path.exists(text_path):
-                os.makedirs(text_path)
-            try:
-                devnull = codecs.open(os.devnull, 'w', encoding='utf-8')
-                if subprocess.call(['ebook-convert', book_file,
-                                    self.txtbook_file],
-                                    stdout=devnull, stderr=devnull):
-                    print "** Error converting to", self.txtbook_file, \
-                      "(maybe DRMed book?)"
-                else:
-                    print ' ->', self.txtbook_file
-            except:
-                print "** Error converting to", self.txtbook_file, \
-                  "(maybe calibre's ebook-convert not installed?)"
-
-        if os.path.exists(self.txtbook_file):
-            self.txtbook = codecs.open(self.txtbook_file,
-                                       encoding='utf-8').read()
-        else:
-            self.txtbook = None
+        text_version(book_file, self.txtbook_file)
+
+        if not os.path.exists(self.txtbook_file):
             print '** Warning: No txt book file, no links will be produced.'
+        self._txtbook = None
+        self.locator = None
+
+    @property
+    def txtbook(self):
+        """The text version of the book, None if there is none.  It is
+        only opened the first time it is needed, and it is memory
+        mapped rather than read.
+        """
+        if self._txtbook is None and os.path.exists(self.txtbook_file):
+            self._txtbook = orgbib.booktext.BookText(self.txtbook_file)
+        return self._txtbook
 
     def bibstr(self):
         return self.bibstr, self.bibid
@@ -118,37 +244,97 @@ class KindleBook(object):
         function attempts to find the closest match.  If it finds it, it
         should be usable as an org-mode link.
         """
-        import difflib
-        book = self.txtbook
-        if book is None:
+        if self.txtbook is None:
             return None
-        s = difflib.SequenceMatcher(None, book, clipping, autojunk=False)
-        loc = s.find_longest_match(0, len(book), 0, len(clipping))
-        if loc:
-            return book[loc.a : loc.a+loc.size]
+        span = self.get_locator().find(clipping)
+        if span:
+            return self.txtbook[span[0]:span[1]]
         return None
 
-    def print_clippings(self, outfile, doctype='book'):
-        def upcase_first(s):
-            return s[0].upper() + s[1:]
-
-        kc = orgbib.parse.Clippings(self.clips_file, self.bu_clips_file)
-
-        skip = set([])
-        present_ids = set([])
-        if os.path.exists(outfile):
-            skip = extract_quotes(outfile)
-            present_ids = extract_ids(outfile)
-
-        clippings = [(clip, meta, note)
-                     for clip, meta, note in kc.list_book(self.title)
-                     if not (upcase_first(clip) in skip)]
+    def locate_clippings(self, clippings, locs=None):
+        """Dictionary from each of the clippings that can be found in the
+        text version of the book to its (start, end) offsets.  The
+        clippings that appear verbatim are all found in a single pass
+        over the text.  If locs maps clippings to their Kindle
+        locations, the rest are first searched for only where their
+        location predicts them to be.
+        """
+        if self.txtbook is None or not clippings:
+            return {}
+        return self.get_locator().find_all(clippings, locs)
+
+    def get_locator(self):
+        if self.locator is None:
+            shadow = orgbib.booktext.Shadow(
+                orgbib.booktext.ensure_shadow(self.txtbook_file))
+            self.locator = orgbib.locate.Locator(self.txtbook, shadow)
+        return self.locator
+
+    def entry_text(self, clip, meta, note, spans):
+        """The *** entry of the clipping clip, located at spans[clip].
+        """
+        text = (u'\n*** ' + upcase_first(u' '.join(clip.split(' ')[:10]))
+                + u'\n')
+        props = ''
+        if meta.when:
+            props = ':added: [%s]\n' % meta.when.isoformat(' ')
+        if meta.loc:
+            props += ':loc: %s\n' % str(meta.loc)
+        if meta.page:
+            props += ':page: %s\n' % str(meta.page)
+        text += u':PROPERTIES:\n%s:END:\n' % props
+        if note:
+            text += upcase_first(note) + u'\n\n'
+        if clip in spans:
+            start, end = spans[clip]
+            link = link_text(self.txtbook[start:end])
+            if link:
+                text += u'[[file:%s::%s][Read more]].\n' % (self.txtbook_file,
+                                                            link)
+        return text + u'\n#+begin_quote\n' + upcase_first(clip) + \
+               u'\n#+end_quote\n'
 
-        ext = os.path.splitext(self.book_file)[1]
-        if not clippings:
+    def print_clippings(self, outfile, doctype='book'):
+        kc = orgbib.parse.shared_clippings(self.clips_file,
+                                           self.bu_clips_file)
+
+        present = orgbib.orgindex.shared_index(outfile)
+
+        clips = [(clip, meta, note)
+                 for clip, meta, note in kc.list_book(self.title)
+                 if meta.kind != 'bookmark']
+        clippings = [(clip, meta, note) for clip, meta, note in clips
+                     if not present.has_quote(upcase_first(clip))]
+
+        ## A book already in the org file only gets its new clippings,
+        ## and the notes added to the old ones.  The file is only read
+        ## if the index says that something is missing.
+        update = present.has_id(self.bibid)
+        notes = []
+        if update:
+            notes = [(upcase_first(clip), upcase_first(note))
+                     for clip, meta, note in clips
+                     if note and present.has_quote(upcase_first(clip))
+                     and not present.has_note(upcase_first(note))]
+        if not clippings and not notes:
             return
 
-        if self.bibid in present_ids:
+        ## Located before anything is written, so that a failure does
+        ## not leave half an entry in the org file.
+        located = [(clip, meta.loc) for clip, meta, note in clippings]
+        spans = self.locate_clippings([clip for clip, loc in located],
+                                      dict(located))
+        entries = u''.join(self.entry_text(clip, meta, note, spans)
+                           for clip, meta, note in clippings)
+        quotes = [upcase_first(clip) for clip, meta, note in clippings]
+        new_notes = [upcase_first(note) for clip, meta, note in clippings
+                     if note]
+
+        if update and self.update_org(outfile, entries, notes):
+            present.appended(quotes,
+                             notes=new_notes + [note for q, note in notes])
+            return
+        elif update:
             print '*** duplicating entry', self.bibid
 
         if not os.path.exists(outfile):
@@ -177,28 +363,32 @@ class KindleBook(object):
                 f.write(u'\n[[paper:%s][Master]].\n' % self.bibid)
                 f.write(u'[[bib:%s][Bib entry]].\n' % self.bibid)
 
-            for clip, meta, note in clippings:
-                if meta.kind != 'bookmark':
-                    f.write(u'\n*** ' +
-                            upcase_first(u' '.join(clip.split(' ')[:10]))
-                            + '\n')
-                    props = ''
-                    if meta.when:
-                        props = ':added: [%s]\n' % meta.when.isoformat(' ')
-                    if meta.loc:
-                        props += ':loc: %s\n' % str(meta.loc)
-                    if meta.page:
-                        props += ':page: %s\n' % str(meta.page)
-                    f.write(u':PROPERTIES:\n%s:END:\n' % props)
-                    if note:
-                        f.write(upcase_first(note) + u'\n\n')
-                    #!!link = self.find_clipping(clip)
-                    link = ''
-                    if link:
-                        f.write(u'[[file:%s::%s][Read more]].\n' %
-                                (self.txtbook_file, link))
-                    f.write(u'\n#+begin_quote\n' + upcase_first(clip) +
-                            u'\n#+end_quote\n')
+            f.write(entries)
+
+        present.appended(quotes, [self.bibid], new_notes)
+
+    def update_org(self, outfile, entries, notes):
+        """Adds entries and notes to the section of the book in outfile,
+        rewriting it atomically, through symlinks and keeping its mode.
+        Returns False if it has no section.
+        """
+        with codecs.open(outfile, encoding='utf-8') as f:
+            lines = f.readlines()
+        new = insert_in_section(lines, self.bibid, entries, notes)
+        if new is None:
+            return False
+        if new != lines:
+            path = os.path.realpath(outfile)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            try:
+                with codecs.open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(u''.join(new))
+                shutil.copymode(path, tmp)
+                os.rename(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        return True
 
 
 def as_main():
@@ -73,14 +73,14 @@ def bibid(title, author, year=''):
         title = '--' + title
     return (author + year + title)
 
-def bibstr(docfile, doctype='book', add_isbn=False):
+def bibstr(docfile, doctype='book', add_isbn=False, interactive=True):
     required = ['title', 'author', 'date']
     if add_isbn:
         required.append('isbn')
     if doctype == 'article':
         required.append('url')
 
-    meta = guess_meta(docfile, required)
+    meta = guess_meta(docfile, required, interactive)
     if 'year' in meta:
         year = meta['year']
     elif 'date' in meta:
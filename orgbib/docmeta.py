@@ -11,14 +11,16 @@ Usage: docmeta book_file[s]
 __date__ = "2013-05-02"
 __author__ = "Juan Reyero, http://juanreyero.com"
 
-import sys, os, codecs
+import sys, os
 import re
 import webbrowser, urllib
 import collections
-import subprocess
 import dateutil.parser
 
 from getch import getch
+from metacache import ebook_meta, shared_cache
+from nativemeta import read_meta
+import calibre
 
 def ensure_comma(author):
     if not u',' in author:
@@ -51,20 +53,25 @@ def parse_author(info):
         out = [info.strip()]
     return [ensure_comma(a) for a in out]
 
-def guess_meta(book, required=None):
-    """Tries to figure out the metadata of the book (title, author and
-    publishing year) using the ebook-meta command line tool from
-    calibre.  Install calibre from http://calibre-ebook.com/, then
-    Preferences -> Miscelaneous -> Install command line tools.
-
-    It requires dateutil-parser.
-
-    If interactive is True and not all data can be read with ebook-meta
-    it will ask for the missing parts.
+class MissingMeta(Exception):
+    """Raised when required metadata is missing and cannot be asked
+    for.
+    """
+    def __init__(self, book, missing):
+        Exception.__init__(self, '%s: missing %s' % (book,
+                                                     ', '.join(missing)))
+        self.book = book
+        self.missing = missing
+
+def calibre_meta(book):
+    """Metadata of the book as read by ebook-meta.  The output of
+    ebook-meta is cached by the contents of the book (see
+    orgbib.metacache), so it is only run once for each version of
+    each book.
     """
     meta = {}
     for line in [re.split(r'\s+:\s+', l) for l in
-                 subprocess.check_output(['ebook-meta', book]).splitlines()]:
+                 ebook_meta(book).splitlines()]:
         if len(line) != 2:
             continue
         what, info = line[0].lower(), line[1]
@@ -86,7 +93,28 @@ def guess_meta(book, required=None):
             meta['date'] = published
         else:
             meta[what] = u'' + info.decode('utf8')
+    return meta
+
+def guess_meta(book, required=None, interactive=True):
+    """Tries to figure out the metadata of the book (title, author and
+    publishing year).  MOBI, EPUB and PDF files are read directly (see
+    orgbib.nativemeta); only for other formats, or books that cannot
+    be read that way, it uses the ebook-meta command line tool from
+    calibre.  Install calibre from http://calibre-ebook.com/,
+    then Preferences -> Miscelaneous -> Install command line tools.
+
+    It requires dateutil-parser.
+
+    If not all the required data can be read it will ask for the
+    missing parts, or raise MissingMeta if interactive is False.
+    """
+    meta = read_meta(book)
+    if meta is None:
+        meta = calibre_meta(book)
     if required:
+        missing = [r for r in required if not r in meta]
+        if missing and not interactive:
+            raise MissingMeta(book, missing)
         for r in required:
             if not r in meta:
                 print 'Missing', r
@@ -134,16 +162,26 @@ def cl_option(fname, val):
         val = str(val.year)
     return u'--' + fname + u'=' + val
 
-def field_to_file(field, value, bookfile):
-    option = cl_option(field, value)
-    if option:
-        devnull = codecs.open(os.devnull, 'w', encoding='utf-8')
-        if subprocess.call(['ebook-meta', option, bookfile],
-                           stdout=devnull, stderr=devnull):
+def fields_to_file(fields, bookfile):
+    """Writes all the fields (a dictionary) to the book with a single
+    call to ebook-meta.
+    """
+    options = [o for o in [cl_option(field, value)
+                           for field, value in sorted(fields.items())] if o]
+    if options:
+        shared_cache().invalidate(bookfile)
+        if calibre.call(['ebook-meta'] + options + [bookfile]):
             print "** Error calling ebook-meta on", bookfile, \
               "(maybe DRMed book?)"
 
+def field_to_file(field, value, bookfile):
+    fields_to_file({field: value}, bookfile)
+
 def interactive_meta(bookfile):
+    """Shows the metadata of bookfile and lets the user edit it.  The
+    edits are kept in memory and written to the book all at once when
+    moving on to the next one.
+    """
     meta = guess_meta(bookfile)
 
     fields = ['author', 'date', 'isbn', 'language', 'publisher',
@@ -209,9 +247,7 @@ def interactive_meta(bookfile):
                 fb = translate[f]
             m = re.search(u'' + fb + '=\{(.+)\}', bs)
             if m:
-                val = formatters[f](m.group(1))
-                field_to_file(f, val, bookfile)
-                newmeta[f] = val
+                newmeta[f] = formatters[f](m.group(1))
         return bs
     formatters['bibstr'] = lambda v: meta_from_bibstr(v)
 
@@ -225,6 +261,7 @@ def interactive_meta(bookfile):
         option = getch()
         if option == 'q' or not option.strip():
             print
+            fields_to_file(newmeta, bookfile)
             return dict(meta.items() + newmeta.items()), option
 
         field = index.get(option, '')
@@ -232,20 +269,11 @@ def interactive_meta(bookfile):
             print
             continue
         print field
-        value = userinput(meta.get(field, u''),
+        value = userinput(newmeta.get(field, meta.get(field, u'')),
                           multiline=field in multiline)
         formatted_value = formatters[field](value)
         if formatted_value:
-            field_to_file(field, formatted_value, bookfile)
-            ##option = cl_option(field, formatted_value)
-            ##if option:
-            ##    devnull = codecs.open(os.devnull, 'w', encoding='utf-8')
-            ##    if subprocess.call(['ebook-meta', option, bookfile],
-            ##                       stdout=devnull, stderr=devnull):
-            ##        print "** Error calling ebook-meta on", bookfile, \
-            ##          "(maybe DRMed book?)"
             newmeta[field] = formatted_value
-            meta = guess_meta(bookfile)
             print_meta(meta, fields, newmeta)
 
 
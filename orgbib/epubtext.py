@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Text version of an EPUB without calibre.
+
+The XHTML documents of the spine are read from the zip in order, a
+chunk at a time, and fed to an incremental HTML parser that writes
+the text out as it goes, so the book is never all in memory.  Blocks
+(paragraphs, headings, list items...) are separated by blank lines,
+as in the text produced by ebook-convert.
+"""
+
+import os
+import re
+import codecs
+import urllib
+import zipfile
+import posixpath
+import htmlentitydefs
+import xml.etree.ElementTree as ET
+from HTMLParser import HTMLParser, HTMLParseError
+
+from orgbib.nativemeta import opf_path
+
+_OPF = '{http://www.idpf.org/2007/opf}'
+
+_BLOCKS = set(['address', 'article', 'aside', 'blockquote', 'dd', 'div',
+               'dl', 'dt', 'figcaption', 'figure', 'footer', 'h1', 'h2',
+               'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p',
+               'pre', 'section', 'table', 'td', 'th', 'tr', 'ul'])
+_SKIP = set(['head', 'script', 'style', 'title'])
+_SPACES = re.compile(r'\s+', re.UNICODE)
+_XML_ENCODING = re.compile(r'''<\?xml[^>]*encoding=["']([\w.-]+)''')
+
+
+def spine(zf):
+    """Paths inside the zip of the documents of the spine, in reading
+    order.
+    """
+    path = opf_path(zf)
+    base = posixpath.dirname(path)
+    package = ET.fromstring(zf.read(path))
+    manifest = {}
+    for item in package.iter(_OPF + 'item'):
+        href = urllib.unquote(item.get('href', '').split('#')[0])
+        manifest[item.get('id')] = posixpath.normpath(
+            posixpath.join(base, href))
+    return [manifest[ref.get('idref')]
+            for ref in package.iter(_OPF + 'itemref')
+            if ref.get('idref') in manifest]
+
+def encrypted(zf):
+    """Whether the zip has encrypted documents (other than fonts).
+    """
+    try:
+        encryption = zf.read('META-INF/encryption.xml')
+    except KeyError:
+        return False
+    uris = re.findall(r'URI="([^"]+)"', encryption)
+    return any(not re.search(r'\.(ttf|otf|woff)$', uri, re.IGNORECASE)
+               for uri in uris)
+
+
+class TextWriter(HTMLParser):
+    """Incremental HTML parser that writes the text of what it is fed
+    to out, a unicode stream.
+
+    >>> import StringIO
+    >>> out = StringIO.StringIO()
+    >>> w = TextWriter(out)
+    >>> for chunk in [u'<html><head><title>T</title></head><body><h1>One', \\
+    ...               u'</h1><p>Caf&eacute; \\n  au <i>lait</i>', \\
+    ...               u'&#8212;ok</p><p>Two<br/>lines</p></body></html>']:
+    ...     w.feed(chunk)
+    >>> w.close()
+    >>> out.getvalue()
+    u'One\\n\\nCaf\\xe9 au lait\\u2014ok\\n\\nTwo\\nlines\\n'
+    """
+    def __init__(self, out):
+        HTMLParser.__init__(self)
+        self.out = out
+        self.skipping = 0
+        ## What has to be written before the next text: nothing, a
+        ## space, a newline or a blank line.
+        self.pending = u''
+        self.started = False
+
+    def separate(self, separator):
+        if self.started and len(separator) > len(self.pending):
+            self.pending = separator
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP:
+            self.skipping += 1
+        elif tag in _BLOCKS:
+            self.separate(u'\n\n')
+        elif tag == 'br':
+            self.separate(u'\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag not in _SKIP:
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in _BLOCKS:
+            self.separate(u'\n\n')
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        text = _SPACES.sub(u' ', data)
+        if text.startswith(u' '):
+            self.separate(u' ')
+            text = text[1:]
+        if not text:
+            return
+        trailing = text.endswith(u' ')
+        self.out.write(self.pending + text.rstrip(u' '))
+        self.pending = u''
+        self.started = True
+        if trailing:
+            self.separate(u' ')
+
+    def handle_entityref(self, name):
+        if name in htmlentitydefs.name2codepoint:
+            self.handle_data(unichr(htmlentitydefs.name2codepoint[name]))
+        else:
+            self.handle_data(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        try:
+            if name[0] in 'xX':
+                c = unichr(int(name[1:], 16))
+            else:
+                c = unichr(int(name))
+        except (ValueError, OverflowError):
+            return
+        self.handle_data(c)
+
+    def close(self):
+        HTMLParser.close(self)
+        if self.started:
+            self.out.write(u'\n')
+
+
+def epub_to_text(epub_file, txt_file, chunk_size=1 << 16):
+    """Writes the text of epub_file to txt_file.  Returns False, and
+    writes nothing, if it cannot be done (not an EPUB, encrypted, or
+    broken), in which case ebook-convert may do better.
+    """
+    tmp = '%s.%d.tmp' % (txt_file, os.getpid())
+    try:
+        with zipfile.ZipFile(epub_file) as zf:
+            if encrypted(zf):
+                return False
+            with codecs.open(tmp, 'w', encoding='utf-8') as out:
+                writer = TextWriter(out)
+                for name in spine(zf):
+                    writer.separate(u'\n\n')
+                    with zf.open(name) as f:
+                        chunk = f.read(chunk_size)
+                        m = _XML_ENCODING.match(chunk)
+                        encoding = m.group(1) if m else 'utf-8'
+                        decoder = codecs.getincrementaldecoder(encoding)(
+                            'replace')
+                        while chunk:
+                            writer.feed(decoder.decode(chunk))
+                            chunk = f.read(chunk_size)
+                    writer.feed(decoder.decode('', final=True))
+                    ## Each document is complete: a tag left open at the
+                    ## end of one must not swallow the next.  Flushed
+                    ## as HTMLParser does, without TextWriter's newline.
+                    HTMLParser.close(writer)
+                    writer.reset()
+                    writer.skipping = 0
+                writer.close()
+        os.rename(tmp, txt_file)
+        return True
+    except (IOError, OSError, KeyError, LookupError, zipfile.BadZipfile,
+            ET.ParseError, HTMLParseError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
@@ -11,7 +11,9 @@ is present (either as /Volumes/Kindle/documents/My Clippings.txt or
 as kindle-clippings.txt in the current directory.)
 
 If no book files are specified it will import all the books in the
-source directory.
+source directory, except those that have not changed since they were
+imported (and are still in the bib file): a manifest of the files
+imported from each source directory is kept in the cache directory.
 
 Usage: refstore [options] [book_file[s]]
 
@@ -30,6 +32,31 @@ Options:
 -d str, --dedrm=str   Directory where the k4mobidedrm.py file of the
                       de-drm distribution (search for apprenticealf)
                       resides.
+-j n, --jobs=n        Number of books to work on at the same time (by
+                      default 1).  Decryption, metadata reading and
+                      conversion run in parallel; the bib and org files
+                      are still written one book at a time, in order.
+                      Books whose metadata has to be asked for are
+                      left for the end.
+-e name, --engine=name  How to work on several books at a time: pool
+                      (by default) prepares each book on one of the
+                      workers; pipeline runs the books through stages
+                      (metadata, mobi conversion, text conversion) with
+                      n workers each, so that the stages of different
+                      books overlap, and reports the time spent in each.
+--stage-jobs=stage:n,...  With the pipeline engine, the number of workers
+                      of some of the stages (meta, mobi, text), as in
+                      meta:4,mobi:2; the rest get n from --jobs.
+--timeout=s           With the pipeline engine, kill the calibre calls
+                      that take more than s seconds.
+-w, --watch           Keep running, importing the books that land in the
+                      source directory and adding to the org file the
+                      clippings of the imported books as they are added
+                      to the clippings file.  The directories are watched
+                      with inotify if possible, and polled otherwise.
+--settle=s            With --watch, wait until a file has not changed
+                      for s seconds (by default 2) before reading it.
+--poll                With --watch, poll even if inotify is available.
 -h, --help            This help.
 """
 __date__ = "2013-04-29"
@@ -39,17 +66,47 @@ import os
 import shutil
 import re
 import codecs
-import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
 
 from cleanup import Cleanup
 import docid
-from clipper import KindleBook
+import calibre
+from docmeta import MissingMeta
+from bibindex import BibIndex
+from manifest import Manifest
+from clipper import KindleBook, text_version
+from pipeline import Pipeline, Stage
+from watch import watcher, Settler
+import parse
+
+
+class ImportJob(object):
+    """What has been worked out about a book before it is added to the
+    bib and org files.
+    """
+    def __init__(self, book, source):
+        self.book = book
+        self.source = source
+        self.ext = os.path.splitext(book)[1]
+        self.bibstr = None
+        self.meta = None
+        ## True or False once the conversion to mobi has been tried.
+        self.converted = None
+        self.deferred = False
+        ## Whether it is the first job with its bibid, and whether the
+        ## bibid was already in the bib file.
+        self.first = False
+        self.present = False
 
 
 class ImportBooks(object):
     def __init__(self, sourcedir, masterdir, bibfile, orgfile,
                  serial=None, alfdir=None, also_repeated=False,
-                 doctype='book'):
+                 doctype='book',
+                 clips_file='/Volumes/Kindle/documents/My Clippings.txt',
+                 bu_clips_file='kindle-clippings.txt',
+                 engine='pool', timeout=None, stage_jobs=None):
         self.sourcedir = os.path.expanduser(sourcedir)
         self.masterdir = os.path.expanduser(masterdir)
         if serial and alfdir:
@@ -57,73 +114,378 @@ class ImportBooks(object):
         else:
             self.cleanup = None
         self.bibfile = os.path.expanduser(bibfile)
+        self.bibindex = BibIndex(self.bibfile)
+        self.manifest = Manifest(self.sourcedir)
         self.orgfile = os.path.expanduser(orgfile)
         self.also_repeated = also_repeated
         self.doctype = doctype
+        self.clips_file = clips_file
+        self.bu_clips_file = bu_clips_file
+        self.text_path = 'text'
+        ## Guards what the workers share: the bib index and the bibids
+        ## being worked on.
+        self.lock = threading.Lock()
+        self.claimed = set()
+        ## Output of the books decrypted in advance, by book.
+        self.decrypted = {}
+        ## How convert_many works on several books at a time, pool or
+        ## pipeline, how long a calibre call may take in it, and how
+        ## many workers each stage of the pipeline has, by name, if not
+        ## as many as jobs.
+        self.engine = engine
+        self.timeout = timeout
+        self.stage_jobs = stage_jobs or {}
+        self.last_pipeline = None
 
     def add_to_bib(self, bibstr, bibid):
-        if os.path.exists(self.bibfile):
-            bib = codecs.open(self.bibfile, encoding='utf-8').read()
-        else:
-            bib = ''
-        if not bibid in bib:
-            with codecs.open(self.bibfile, 'a', encoding='utf-8') as f:
-                f.write(u'\n' + bibstr + u'\n')
-            return True
+        with self.lock:
+            if not bibid in self.bibindex:
+                with codecs.open(self.bibfile, 'a', encoding='utf-8') as f:
+                    f.write(u'\n' + bibstr + u'\n')
+                self.bibindex.appended(bibstr)
+                return True
         return False
 
     def clippings_to_org(self, bookfile, meta):
-        kc = KindleBook(bookfile, text_path='text', meta=meta)
+        kc = KindleBook(bookfile, text_path=self.text_path,
+                        clips_file=self.clips_file,
+                        bu_clips_file=self.bu_clips_file, meta=meta)
         kc.print_clippings(self.orgfile, self.doctype)
 
-    def convert(self, book, bu_dir='imported'):
+    def to_mobi(self, book, newbook):
+        if calibre.call(['ebook-convert', book, newbook]):
+            print ("** Error converting to " + newbook +
+                   " (maybe DRMed book?)")
+            return False
+        return True
+
+    def prepare(self, book, interactive=True):
+        """Does the work on book that does not touch the bib and org
+        files: decrypting it, reading its metadata and converting it.
+        Returns an ImportJob, or None if the book cannot be imported.
+        If interactive is False and some metadata is missing the job
+        is returned as deferred, to be finished with identify.
+        """
+        job = self.open_book(book)
+        if job is None:
+            return None
+        return self.identify(job, interactive)
+
+    def open_book(self, book):
+        """ImportJob for book, decrypted if needed, or None if it cannot
+        be.
+        """
         if not os.path.exists(book):
             book = os.path.join(self.sourcedir, book)
-        print book
-        original_book = book
-        ext = os.path.splitext(book)[1]
-        if ext == '.azw':
+        job = ImportJob(book, book)
+        if job.ext == '.azw':
             if self.cleanup:
-                book = self.cleanup.decrypt(book)
+                decrypted = self.decrypted.pop(os.path.expanduser(book), None)
+                if decrypted:
+                    job.source = decrypted
+                else:
+                    job.source = self.cleanup.decrypt(book)
+                if job.source is None:
+                    return None
             else:
                 print ("** Won't be able to clean up " + book +
                        ", need a kindle serial")
-                return
+                return None
+        return job
 
-        bibstr, meta = docid.bibstr(book, self.doctype, add_isbn=True)
-        bibid = meta['bibid']
+    def identify(self, job, interactive=True):
+        self.read_meta(job, interactive)
+        if not job.deferred:
+            self.make_mobi(job)
+            self.make_text(job)
+        return job
 
-        new = self.add_to_bib(bibstr, bibid)
+    def read_meta(self, job, interactive=True):
+        """Works out the bib entry of the book.  The first job to get a
+        bibid is the one that converts the book.
+        """
+        try:
+            job.bibstr, job.meta = docid.bibstr(job.source, self.doctype,
+                                                add_isbn=True,
+                                                interactive=interactive)
+        except MissingMeta:
+            job.deferred = True
+            return job
+        job.deferred = False
+        bibid = job.meta['bibid']
+        with self.lock:
+            ## Only the first of the books with the same bibid is
+            ## converted ahead of time.
+            job.first = bibid not in self.claimed
+            self.claimed.add(bibid)
+            job.present = bibid in self.bibindex
+        return job
+
+    def make_mobi(self, job):
+        if (not job.deferred and job.first and
+            (not job.present or self.also_repeated) and
+            job.ext not in ('.mobi', '.pdf')):
+            job.converted = self.to_mobi(
+                job.source,
+                os.path.join(self.masterdir, job.meta['bibid'] + '.mobi'))
+        return job
+
+    def make_text(self, job):
+        if not job.deferred and job.first:
+            text_version(job.source, os.path.join(self.text_path,
+                                                  job.meta['bibid'] + '.txt'))
+        return job
+
+    def install(self, job, bu_dir='imported'):
+        """Adds a prepared book to the bib and org files and moves it to
+        the master directory.
+        """
+        print job.book
+        bibid = job.meta['bibid']
+        signature = self.manifest.signature(job.book)
+        new = self.add_to_bib(job.bibstr, bibid)
         newbook = os.path.join(self.masterdir, bibid)
         if new or self.also_repeated:
-            if ext in ('.mobi', '.pdf'):
-                newbook = newbook + ext
-                os.rename(book, newbook)
+            if job.ext in ('.mobi', '.pdf'):
+                newbook = newbook + job.ext
+                os.rename(job.source, newbook)
             else:
                 newbook = newbook + '.mobi'
-                devnull = codecs.open(os.devnull, 'w', encoding='utf-8')
-                if subprocess.call(['ebook-convert', book,
-                                    newbook],
-                                    stdout=devnull, stderr=devnull):
-                    print ("** Error converting to " + newbook +
-                           " (maybe DRMed book?)")
+                if job.converted is None:
+                    job.converted = self.to_mobi(job.source, newbook)
+                if not job.converted:
                     return None
-                else:
-                    if not os.path.exists(bu_dir):
-                        os.mkdir(bu_dir)
-                    bu = os.path.join(bu_dir, bibid + ext)
-                    print '  ...moving away', original_book, 'to', bu
-                    shutil.move(original_book, bu)
+                if not os.path.exists(bu_dir):
+                    os.mkdir(bu_dir)
+                bu = os.path.join(bu_dir, bibid + job.ext)
+                print '  ...moving away', job.book, 'to', bu
+                shutil.move(job.book, bu)
 
-        self.clippings_to_org(newbook, meta)
+        self.clippings_to_org(newbook, job.meta)
+        self.manifest.record(job.book, bibid, job.meta['title'],
+                             [newbook, os.path.join(self.text_path,
+                                                    bibid + '.txt')],
+                             signature, job.meta)
         print ' ->', newbook
         return newbook
 
-    def convert_all(self):
-        for book in os.listdir(self.sourcedir):
-            ext = os.path.splitext(book)[1]
-            if ext in ('.azw', '.epub', '.mobi', '.pdf'):
-                self.convert(book)
+    def convert(self, book, bu_dir='imported'):
+        job = self.prepare(book)
+        if job is None:
+            return None
+        return self.install(job, bu_dir)
+
+    def _prepare_quietly(self, book):
+        try:
+            return self.prepare(book, interactive=False)
+        except Exception, e:
+            print '** Error preparing', book, '(%s)' % e
+            return None
+
+    def decrypt_all(self, books):
+        """Decrypts at once, in parallel, the azw books among books.
+        Those that cannot be decrypted are reported and left out.
+        """
+        paths = [book if os.path.exists(book)
+                 else os.path.join(self.sourcedir, book) for book in books]
+        azw = [p for p in paths if os.path.splitext(p)[1] == '.azw']
+        if not self.cleanup or not azw:
+            return books
+        failed = set()
+        for result in self.cleanup.decrypt_many(azw):
+            if result.output is None:
+                print result
+                failed.add(result.book)
+            else:
+                self.decrypted[result.book] = result.output
+        return [book for book, p in zip(books, paths)
+                if os.path.expanduser(p) not in failed]
+
+    def convert_many(self, books, jobs=1, interactive=True):
+        """Imports books.  With more than one job, the calibre calls
+        for different books run in parallel, while the bib and org
+        files are written by a single writer in the order of books.
+        Books whose metadata has to be asked for are left for the end,
+        so that the prompts do not hold back the workers, or only
+        reported if not interactive.  The azw books are decrypted
+        first, all together.
+        """
+        try:
+            books = self.decrypt_all(books)
+            if jobs <= 1 and interactive:
+                for book in books:
+                    self.convert(book)
+            elif self.engine == 'pipeline':
+                self.convert_pipeline(books, max(jobs, 1), interactive)
+            else:
+                self.convert_pool(books, max(jobs, 1), interactive)
+        finally:
+            self.manifest.save()
+
+    def convert_pool(self, books, jobs, interactive=True):
+        deferred = []
+        pool = ThreadPool(jobs)
+        try:
+            for job in pool.imap(self._prepare_quietly, books):
+                if job is None:
+                    continue
+                if job.deferred:
+                    deferred.append(job)
+                else:
+                    self.install(job)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.install_deferred(deferred, interactive)
+
+    def install_deferred(self, deferred, interactive=True):
+        """Asks for the metadata of the deferred jobs and installs them,
+        or only reports them if not interactive.
+        """
+        for job in deferred:
+            if not interactive:
+                print '** Metadata missing for', job.book, \
+                      '(import it with bibimport)'
+            elif self.identify(job) is not None:
+                self.install(job)
+
+    def _open_and_read_meta(self, book):
+        job = self.open_book(book)
+        if job is not None:
+            job = self.read_meta(job, interactive=False)
+        return job
+
+    def convert_pipeline(self, books, jobs=2, interactive=True):
+        """Imports books through a pipeline of stages (see
+        orgbib.pipeline): reading the metadata, converting to mobi and
+        converting to text, with jobs workers each unless
+        self.stage_jobs says otherwise.  The books are added to the bib
+        and org files as they come out of it, in order, while the next
+        ones are still being converted.  Hung calibre processes are
+        killed after self.timeout seconds.
+        """
+        stages = [Stage(name, func, self.stage_jobs.get(name, jobs),
+                        self.timeout)
+                  for name, func in (('meta', self._open_and_read_meta),
+                                     ('mobi', self.make_mobi),
+                                     ('text', self.make_text))]
+        pipeline = self.last_pipeline = Pipeline(stages)
+        deferred = []
+        for job in pipeline.run(books):
+            if job is None:
+                continue
+            if job.deferred:
+                deferred.append(job)
+            else:
+                self.install(job)
+        print pipeline.report()
+
+        self.install_deferred(deferred, interactive)
+
+    def already_imported(self, book):
+        """Whether book is unchanged since it was imported, and its
+        entry is still in the bib file.  Only needs to stat it.
+        """
+        if self.also_repeated:
+            return False
+        entry = self.manifest.unchanged(os.path.join(self.sourcedir, book))
+        return entry is not None and entry['bibid'] in self.bibindex
+
+    def source_books(self):
+        return [book for book in sorted(os.listdir(self.sourcedir))
+                if os.path.splitext(book)[1] in
+                ('.azw', '.epub', '.mobi', '.pdf')]
+
+    def convert_all(self, jobs=1):
+        """Imports the books in the source directory, skipping those
+        that the manifest says have already been imported.
+        """
+        books = self.source_books()
+        new = [book for book in books if not self.already_imported(book)]
+        if len(new) < len(books):
+            print len(books) - len(new), 'books already imported'
+        self.convert_many(new, jobs)
+
+    def clipping_state(self):
+        """The number of clippings and of notes of each book in the
+        clippings file.  A note does not add a clipping, it is attached
+        to the highlight before it, so both have to be compared.
+        """
+        kc = parse.shared_clippings(self.clips_file, self.bu_clips_file)
+        return dict((book, (len(clips), len([c for c in clips if c[2]])))
+                    for book, clips in kc.clips.iteritems())
+
+    def new_clippings(self, state):
+        """Adds to the org file the new clippings and notes of the
+        imported books, those whose clippings differ from state.
+        Returns the new state.
+        """
+        new_state = self.clipping_state()
+        changed = [book for book, n in new_state.iteritems()
+                   if n != state.get(book)]
+        if not changed:
+            return new_state
+        kc = parse.shared_clippings(self.clips_file, self.bu_clips_file)
+        imported = {}
+        for entry in self.manifest.entries.itervalues():
+            imported.setdefault(kc.book_full_name(entry['title']), entry)
+        for book in sorted(changed):
+            entry = imported.get(book)
+            if (entry is None or not entry.get('meta') or
+                not os.path.exists(entry['outputs'][0])):
+                print '** New clippings of', book, 'not imported by bibimport'
+                continue
+            print 'New clippings of', entry['outputs'][0]
+            self.clippings_to_org(entry['outputs'][0], entry['meta'])
+        return new_state
+
+    def watch(self, jobs=1, settle=2.0, interval=60.0, poll=False):
+        """Imports the books that land in the source directory, once
+        they have not changed for settle seconds, and appends to the
+        org file the clippings added to the clippings file, until
+        interrupted.  The clippings are kept parsed between changes.
+        Nothing is asked: books without metadata are only reported, and
+        errors only stop the import of the books that were ready.
+        """
+        clips_dirs = [os.path.dirname(os.path.abspath(f))
+                      for f in (self.clips_file, self.bu_clips_file) if f]
+        waiter = watcher([self.sourcedir] + clips_dirs, poll)
+        print 'Watching', ', '.join(waiter.watched or
+                                    ['by polling every %gs' % settle])
+        if not waiter.watched:
+            interval = settle
+        settler = Settler(settle)
+        state = self.clipping_state()
+        try:
+            while True:
+                books = [os.path.join(self.sourcedir, book)
+                         for book in self.source_books()
+                         if not self.already_imported(book)]
+                clips = parse.clippings_source(self.clips_file,
+                                               self.bu_clips_file)
+                ready = settler.ready(books + [clips] if clips else books)
+                ## Nobody is there to answer prompts, and a bad book or
+                ## clippings file must not stop the watching.
+                if clips in ready:
+                    ready.remove(clips)
+                    try:
+                        state = self.new_clippings(state)
+                    except Exception, e:
+                        print '** Error adding the new clippings', \
+                              '(%s)' % e
+                if ready:
+                    try:
+                        self.convert_many(ready, jobs, interactive=False)
+                        state = self.clipping_state()
+                    except Exception, e:
+                        print '** Error importing', ', '.join(ready), \
+                              '(%s)' % e
+                waiter.wait(settle if settler.pending() else interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            waiter.close()
 
 
 def as_main():
@@ -132,9 +494,12 @@ def as_main():
         print __doc__ % (__author__, __date__)
 
     from getopt import getopt
-    opts, files = getopt(sys.argv[1:], 'hm:s:b:o:at:k:d:',
+    opts, files = getopt(sys.argv[1:], 'hm:s:b:o:at:k:d:j:e:w',
                          ['help', 'master=', 'source=', 'bib=', 'org=',
-                          'also-repeated', 'type=', 'kindle=', 'dedrm='])
+                          'also-repeated', 'type=', 'kindle=', 'dedrm=',
+                          'jobs=', 'engine=', 'timeout=', 'stage-jobs=',
+                          'watch',
+                          'settle=', 'poll'])
     master = ''
     source = ''
     also_repeated = False
@@ -143,6 +508,13 @@ def as_main():
     alfdir = None
     bibfile = 'ref.bib'
     orgfile = 'ref.org'
+    jobs = 1
+    engine = 'pool'
+    timeout = None
+    stage_jobs = {}
+    watch = False
+    settle = 2.0
+    poll = False
     for (opt, val) in opts:
         if   opt == '-h' or opt == '--help':
             help()
@@ -163,15 +535,40 @@ def as_main():
             serial = val
         elif opt == '-d' or opt == '--dedrm':
             alfdir = val
+        elif opt == '-j' or opt == '--jobs':
+            jobs = int(val)
+        elif opt == '-e' or opt == '--engine':
+            engine = val
+        elif opt == '--timeout':
+            timeout = float(val)
+        elif opt == '--stage-jobs':
+            for stage in val.split(','):
+                name, n = stage.split(':')
+                stage_jobs[name.strip()] = int(n)
+                if int(n) < 1:
+                    print '** Each stage needs at least one worker:', stage
+                    help()
+                    sys.exit(1)
+        elif opt == '-w' or opt == '--watch':
+            watch = True
+        elif opt == '--settle':
+            settle = float(val)
+        elif opt == '--poll':
+            poll = True
 
     fr = ImportBooks(source, master, bibfile, orgfile,
-                     serial, alfdir, also_repeated, doctype)
+                     serial, alfdir, also_repeated, doctype,
+                     engine=engine, timeout=timeout,
+                     stage_jobs=stage_jobs)
 
-    if files:
-        for fname in files:
-            fr.convert(fname)
+    if watch:
+        fr.watch(jobs, settle, poll=poll)
+    elif files:
+        fr.convert_many(files, jobs)
     else:
-        fr.convert_all()
+        fr.convert_all(jobs)
+    if fr.cleanup:
+        fr.cleanup.close()
 
 if __name__ == '__main__':
     as_main()
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""Locate clippings in the text version of a book.
+
+Clippings rarely match the converted text exactly (line breaks,
+whitespace, quotes), so they are located approximately: the book is
+indexed by word shingles (runs of k consecutive words), the shingles
+of the clipping vote for the regions of the book where it might be,
+and the fine-grained alignment runs only inside those regions.
+"""
+
+import collections
+import difflib
+import re
+
+from orgbib.booktext import normalize_clipping
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+def words(text):
+    """Lower-cased words of text with their (start, end) offsets.
+
+    >>> words(u'Hello,  brave\\nnew World')
+    [(u'hello', 0, 5), (u'brave', 8, 13), (u'new', 14, 17), (u'world', 18, 23)]
+    """
+    return [(m.group().lower(), m.start(), m.end())
+            for m in _WORD_RE.finditer(text)]
+
+def shingles(tokens, k):
+    """Hashes of the runs of k consecutive tokens.
+
+    >>> len(shingles([u'a', u'b', u'c', u'd'], 3))
+    2
+    """
+    return [hash(tuple(tokens[i:i+k])) for i in xrange(len(tokens) - k + 1)]
+
+def align(text, clipping, start=0, end=None, min_block=4):
+    """Aligns clipping with text[start:end] and returns the (start,
+    end) offsets in text of the region that matches it, or None if
+    less than half of the clipping could be matched.
+
+    >>> align(u'one two three four five six', u'three  four', 0)
+    (8, 18)
+    """
+    if end is None:
+        end = len(text)
+    window = text[start:end]
+    matcher = difflib.SequenceMatcher(None, window, clipping,
+                                      autojunk=False)
+    blocks = [b for b in matcher.get_matching_blocks() if b.size]
+    if sum(b.size for b in blocks) * 2 < len(clipping):
+        return None
+    ## Scattered single characters match anywhere; the region is
+    ## delimited by the blocks that mean something.
+    solid = [b for b in blocks if b.size >= min_block] or \
+            [max(blocks, key=lambda b: b.size)]
+    return start + solid[0].a, start + solid[-1].a + solid[-1].size
+
+
+class ShingleIndex(object):
+    """Word shingle index of a text, or of the text[start:end] window
+    of it, used to find where a clipping is.  Shingles that appear
+    more than max_hits times in the book ("of the same") are ignored
+    when voting, they say nothing about where a clipping is.
+    """
+    def __init__(self, text, start=0, end=None, k=3, max_hits=50):
+        self.text = text
+        self.start = start
+        self.end = len(text) if end is None else end
+        self.k = k
+        self.max_hits = max_hits
+        tokens = words(text[self.start:self.end])
+        self.starts = [t[1] + self.start for t in tokens]
+        self.ends = [t[2] + self.start for t in tokens]
+        self.index = collections.defaultdict(list)
+        for pos, h in enumerate(shingles([t[0] for t in tokens], k)):
+            self.index[h].append(pos)
+
+    def candidates(self, clipping, n=3, window=None):
+        """Up to n (start, end) windows of the text in which clipping
+        is likely to be, best first.  If window is given only the
+        shingles of the book that start within it are considered.
+        """
+        tokens = [t[0] for t in words(clipping)]
+        lo, hi = window or (self.start, self.end)
+        starts = self.starts
+        votes = collections.Counter()
+        for i, h in enumerate(shingles(tokens, self.k)):
+            hits = self.index.get(h, ())
+            if len(hits) <= self.max_hits:
+                for pos in hits:
+                    if lo <= starts[pos] < hi:
+                        votes[pos - i] += 1
+        slack = max(3, len(tokens) / 4)
+        windows = []
+        for diagonal, count in votes.most_common(n):
+            first = max(0, diagonal - slack)
+            last = min(len(self.starts), diagonal + len(tokens) + slack) - 1
+            if first <= last:
+                windows.append((self.starts[first], self.ends[last]))
+        return windows
+
+    def find(self, clipping, window=None):
+        """(start, end) offsets of the region of the text that best
+        matches clipping, or None if it cannot be found.
+        """
+        for start, end in self.candidates(clipping, window=window):
+            span = align(self.text, clipping, start, end)
+            if span:
+                return span
+        ## Too short to have shingles.
+        lo, hi = window or (self.start, self.end)
+        i = self.text.find(clipping, lo, hi)
+        if i >= 0:
+            return i, i + len(clipping)
+        return None
+
+
+class LocCalibration(object):
+    """Linear fit of Kindle locations to offsets in the text, from the
+    clippings that have already been located, to predict where in the
+    text the rest should be.
+
+    >>> cal = LocCalibration(min_margin=100)
+    >>> cal.window((10,), 50) is None
+    True
+    >>> for loc, offset in [(10, 1500), (20, 3010), (40, 5990)]:
+    ...     cal.add((loc,), offset)
+    >>> cal.window((30, 31), 50)
+    (4397, 4647)
+    """
+    def __init__(self, min_margin=1500):
+        self.min_margin = min_margin
+        self.points = []
+        self.fit = None
+
+    def add(self, loc, offset):
+        if loc:
+            self.points.append((loc[0], offset))
+            self.fit = None
+
+    def fitted(self):
+        """(slope, intercept, margin) of the fit, None if there are
+        not enough points.  The margin grows with the typical distance
+        of the points to the fitted line.
+        """
+        if self.fit is None:
+            n = len(self.points)
+            if n < 2 or len(set(l for l, o in self.points)) < 2:
+                return None
+            mean_l = sum(l for l, o in self.points) / float(n)
+            mean_o = sum(o for l, o in self.points) / float(n)
+            slope = (sum((l - mean_l) * (o - mean_o) for l, o in self.points) /
+                     sum((l - mean_l) ** 2 for l, o in self.points))
+            intercept = mean_o - slope * mean_l
+            residuals = sorted(abs(o - (slope * l + intercept))
+                               for l, o in self.points)
+            margin = max(self.min_margin, 4 * residuals[n / 2])
+            self.fit = slope, intercept, margin
+        return self.fit
+
+    def window(self, loc, length, widen=1):
+        """(start, end) window of the text where a clipping of the
+        given length and Kindle location is predicted to be, or None
+        if there is no prediction yet.  widen multiplies the margin
+        around the prediction.
+        """
+        fit = self.fitted()
+        if not loc or fit is None:
+            return None
+        slope, intercept, margin = fit
+        predicted = slope * loc[0] + intercept
+        margin *= widen
+        return (max(0, int(predicted - margin)),
+                int(predicted + length + margin))
+
+
+class Automaton(object):
+    """Aho-Corasick automaton to find all the occurrences of many
+    patterns in a single pass over a text.
+
+    >>> sorted(Automaton([u'he', u'she', u'hers']).search(u'ushers'))
+    [(1, 1), (2, 0), (2, 2)]
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for i, pattern in enumerate(patterns):
+            state = 0
+            for c in pattern:
+                if c not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][c] = len(self.goto) - 1
+                state = self.goto[state][c]
+            self.out[state].append(i)
+
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, child in self.goto[state].iteritems():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(c, 0)
+                self.out[child] = self.out[child] + \
+                                  self.out[self.fail[child]]
+
+    def search(self, text):
+        """Yields (start, pattern index) for every occurrence of the
+        patterns in text.
+        """
+        goto, fail, out, patterns = \
+              self.goto, self.fail, self.out, self.patterns
+        state = 0
+        for pos, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for i in out[state]:
+                yield pos - len(patterns[i]) + 1, i
+
+
+def find_exact(text, clippings, prefix=64):
+    """Finds the first exact occurrence of each clipping in text with
+    a single pass over it.  Returns a dictionary from clipping to its
+    (start, end) offsets, without the clippings that do not appear.
+
+    Only the first prefix characters of the clippings go into the
+    automaton, to keep it small; the rest is checked in place.
+
+    >>> sorted(find_exact(u'a cat and a dog', [u'a dog', u'a cat', u'a cow']).items())
+    [(u'a cat', (0, 5)), (u'a dog', (10, 15))]
+    """
+    clippings = [c for c in set(clippings) if c]
+    heads = sorted(set(c[:prefix] for c in clippings))
+    by_head = collections.defaultdict(list)
+    for c in clippings:
+        by_head[c[:prefix]].append(c)
+    found = {}
+    if not heads:
+        return found
+    for start, i in Automaton(heads).search(text):
+        for c in by_head[heads[i]]:
+            if c not in found and text[start:start + len(c)] == c:
+                found[c] = (start, start + len(c))
+        if len(found) == len(clippings):
+            break
+    return found
+
+
+class Locator(object):
+    """Finds clippings in the text of a book, combining the locators
+    above: verbatim clippings are all found in a single pass, the
+    Kindle locations of those calibrate where in the text the rest
+    should be, and only if a clipping is not found in its predicted
+    window is it searched for in the whole book.
+
+    If the normalized shadow of the text (see orgbib.booktext) is
+    given the verbatim search runs on it, so that differences in
+    case, spacing or quotes do not prevent exact matches.
+    """
+    def __init__(self, text, shadow=None):
+        self.text = text
+        self.shadow = shadow
+        self.index = None
+
+    def find(self, clipping, window=None):
+        """(start, end) offsets of the closest match of clipping in the
+        text, or in the given (start, end) window of it.  None if it
+        cannot be found.
+        """
+        if self.shadow is not None and window is None:
+            span = self.shadow.find(clipping)
+            if span is not None:
+                return span
+        if window is not None and self.index is None:
+            ## Indexing the window is cheaper than indexing the book,
+            ## unless the book has already been indexed.
+            return ShingleIndex(self.text, *window).find(clipping)
+        if self.index is None:
+            self.index = ShingleIndex(self.text)
+        return self.index.find(clipping, window)
+
+    def find_exact(self, clippings):
+        if self.shadow is None:
+            return find_exact(self.text, clippings)
+        normalized = collections.defaultdict(list)
+        for clip in clippings:
+            normalized[normalize_clipping(clip)].append(clip)
+        spans = {}
+        for needle, (start, end) in find_exact(self.shadow.text(),
+                                               normalized.keys()).iteritems():
+            for clip in normalized[needle]:
+                spans[clip] = self.shadow.original_span(start, end)
+        return spans
+
+    def find_all(self, clippings, locs=None):
+        """Dictionary from each of the clippings that can be found to its
+        (start, end) offsets.  locs, if given, maps clippings to their
+        Kindle location.
+        """
+        locs = locs or {}
+        spans = self.find_exact(clippings)
+        calibration = LocCalibration()
+        for clip, span in spans.iteritems():
+            calibration.add(locs.get(clip), span[0])
+        for clip in clippings:
+            if clip in spans:
+                continue
+            span = None
+            for widen in (1, 4):
+                window = calibration.window(locs.get(clip), len(clip), widen)
+                if window is None:
+                    break
+                span = self.find(clip, window)
+                if span is not None:
+                    break
+            if span is None:
+                span = self.find(clip)
+            if span is not None:
+                spans[clip] = span
+                calibration.add(locs.get(clip), span[0])
+        return spans
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Manifest of the books imported from a source directory: for each
+file, its size, modification time and content hash, and the bibid,
+title, metadata and output files it produced.
+
+With it a new run over the same directory tells from a stat of each
+file which ones it has already seen, without reading their metadata
+again.  A file whose size and modification time have changed is only
+taken as changed if its contents have.
+
+It is kept next to the other cached state (see orgbib.store).
+"""
+
+import os
+
+from orgbib.store import file_signature, cache_path, load_state, save_state
+from orgbib.metacache import content_hash
+
+
+class Manifest(object):
+    """
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> book = os.path.join(tmp, 'book.epub')
+    >>> with open(book, 'w') as f: f.write('contents')
+    >>> m = Manifest(tmp, os.path.join(tmp, 'manifest.pickle'))
+    >>> m.unchanged(book) is None
+    True
+    >>> m.record(book, 'a-2000--book', u'A Book', [u'master/a-2000--book.mobi'])
+    >>> m.save()
+    >>> m = Manifest(tmp, os.path.join(tmp, 'manifest.pickle'))
+    >>> m.unchanged(book)['bibid']
+    'a-2000--book'
+    >>> os.utime(book, (0, 0))
+    >>> m.unchanged(book)['title']
+    u'A Book'
+    >>> with open(book, 'w') as f: f.write('new contents')
+    >>> m.unchanged(book) is None
+    True
+    >>> m.by_bibid('a-2000--book')['outputs']
+    [u'master/a-2000--book.mobi']
+    >>> shutil.rmtree(tmp)
+    """
+    def __init__(self, sourcedir, manifest_file=None):
+        self.manifest_file = manifest_file or cache_path('import', sourcedir)
+        self.entries = load_state(self.manifest_file) or {}
+        self.dirty = False
+
+    def unchanged(self, fname):
+        """The entry of fname if it has not changed since it was
+        recorded, None otherwise.
+        """
+        entry = self.entries.get(os.path.abspath(fname))
+        signature = file_signature(fname)
+        if entry is None or signature is None:
+            return None
+        if entry['signature'] == signature:
+            return entry
+        if (entry['signature'][0] == signature[0] and
+            content_hash(fname) == entry['hash']):
+            ## Touched, but the same.
+            entry['signature'] = signature
+            self.dirty = True
+            return entry
+        return None
+
+    def signature(self, fname):
+        """What has to be recorded of fname, taken before it is moved.
+        """
+        return file_signature(fname), content_hash(fname)
+
+    def record(self, fname, bibid, title, outputs=(), signature=None,
+               meta=None):
+        """Records that fname, with the (file signature, content hash)
+        signature (by default, that of the file as it is now),
+        produced the given bibid and output files, from the metadata
+        in meta.
+        """
+        if signature is None:
+            signature = self.signature(fname)
+        self.entries[os.path.abspath(fname)] = {
+            'signature': signature[0], 'hash': signature[1],
+            'bibid': bibid, 'title': title, 'outputs': list(outputs),
+            'meta': meta}
+        self.dirty = True
+
+    def by_bibid(self, bibid):
+        """An entry recorded with bibid, or None.
+        """
+        for entry in self.entries.itervalues():
+            if entry['bibid'] == bibid:
+                return entry
+        return None
+
+    def save(self):
+        if self.dirty:
+            save_state(self.manifest_file, self.entries)
+            self.dirty = False
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Persistent cache of the output of ebook-meta.
+
+Starting calibre is what makes ebook-meta slow, and the metadata of a
+book only changes when it is written to.  The output of ebook-meta is
+kept in an SQLite database in the cache directory (see orgbib.store),
+keyed by the SHA-1 of the contents of the book.  A second table maps
+the path, size and modification time of each book seen to that hash,
+so that unchanged books are not even read again; a book that has been
+moved or copied is hashed, and found by its contents.
+
+Writing metadata to a book with ebook-meta changes its contents, so
+the old entry would never be found again anyway; field_to_file
+invalidates it explicitly nonetheless.
+"""
+
+import os
+import sqlite3
+import hashlib
+
+from orgbib.store import cache_dir, file_signature
+from orgbib.calibre import check_output
+
+_SCHEMA = """
+create table if not exists files (path text primary key, size integer,
+                                  mtime real, hash text);
+create table if not exists meta (hash text primary key, output blob);
+"""
+
+def content_hash(fname, chunk_size=1 << 20):
+    """SHA-1 of the contents of fname.
+    """
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            h.update(chunk)
+            chunk = f.read(chunk_size)
+    return h.hexdigest()
+
+
+class MetaCache(object):
+    """Output of ebook-meta (or of any other command run on a book),
+    cached by the contents of the book.  Errors of the database are
+    not errors of the cache: the command is just run again.
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> book = os.path.join(tmp, 'book.epub')
+    >>> with open(book, 'wb') as f: f.write('contents')
+    >>> calls = []
+    >>> def run(fname):
+    ...     calls.append(fname)
+    ...     return 'Title : A book'
+    >>> cache = MetaCache(os.path.join(tmp, 'meta.sqlite'), run)
+    >>> cache.output(book), cache.output(book), len(calls)
+    ('Title : A book', 'Title : A book', 1)
+    >>> shutil.copy(book, book + '.copy')
+    >>> cache.output(book + '.copy'), len(calls)
+    ('Title : A book', 1)
+    >>> cache.invalidate(book)
+    >>> cache.output(book), len(calls)
+    ('Title : A book', 2)
+    >>> shutil.rmtree(tmp)
+    """
+    def __init__(self, db_file, run):
+        self.db_file = db_file
+        self.run = run
+
+    def connect(self):
+        """A new connection to the database: sqlite3 connections cannot
+        be shared between the threads of the importer.
+        """
+        dirname = os.path.dirname(self.db_file)
+        if dirname and not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+        db = sqlite3.connect(self.db_file, timeout=30)
+        db.text_factory = str
+        db.executescript(_SCHEMA)
+        return db
+
+    def lookup(self, db, book, signature):
+        """Hash and cached output of book, either of them None if
+        not known.
+        """
+        path = os.path.abspath(book)
+        row = db.execute('select size, mtime, hash from files where path = ?',
+                         (path,)).fetchone()
+        if row and (row[0], row[1]) == signature:
+            digest = row[2]
+        else:
+            digest = content_hash(book)
+            with db:
+                db.execute('insert or replace into files values (?, ?, ?, ?)',
+                           (path, signature[0], signature[1], digest))
+        row = db.execute('select output from meta where hash = ?',
+                         (digest,)).fetchone()
+        return digest, row and str(row[0])
+
+    def output(self, book):
+        signature = file_signature(book)
+        if signature is None:
+            return self.run(book)
+        try:
+            db = self.connect()
+        except sqlite3.Error:
+            return self.run(book)
+        try:
+            digest, output = self.lookup(db, book, signature)
+            if output is None:
+                output = self.run(book)
+                with db:
+                    db.execute('insert or replace into meta values (?, ?)',
+                               (digest, sqlite3.Binary(output)))
+            return output
+        except sqlite3.Error:
+            return self.run(book)
+        finally:
+            db.close()
+
+    def invalidate(self, book):
+        """Forgets what was cached for the current contents of book.
+        """
+        try:
+            db = self.connect()
+        except sqlite3.Error:
+            return
+        try:
+            path = os.path.abspath(book)
+            with db:
+                row = db.execute('select hash from files where path = ?',
+                                 (path,)).fetchone()
+                if row:
+                    db.execute('delete from meta where hash = ?', row)
+                db.execute('delete from files where path = ?', (path,))
+        except sqlite3.Error:
+            pass
+        finally:
+            db.close()
+
+
+def run_ebook_meta(book):
+    return check_output(['ebook-meta', book])
+
+_shared = []
+
+def shared_cache():
+    """The cache of ebook-meta, in the cache directory.
+    """
+    if not _shared:
+        _shared.append(MetaCache(os.path.join(cache_dir(),
+                                              'ebook-meta.sqlite'),
+                                 run_ebook_meta))
+    return _shared[0]
+
+def ebook_meta(book):
+    """Output of ebook-meta for book, from the cache if possible.
+    """
+    return shared_cache().output(book)
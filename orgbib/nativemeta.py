@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""Read the metadata of MOBI (and AZW, AZW3), EPUB and PDF files
+without calibre.
+
+ebook-meta starts a whole calibre interpreter for every book, which
+takes about a second.  The readers here look at the few bytes that
+hold the metadata: the EXTH records of the MOBI header, the OPF
+package document of the EPUB, and the Info dictionary and XMP packet
+of the PDF.  read_meta returns the metadata in the same shape as
+docmeta.guess_meta (title, author as a list, date as a datetime,
+isbn, publisher, language), or None if the format is not known or the
+file cannot be read, in which case calibre is still the way to go.
+When a book can be read, what is missing from the result is missing
+from the book too, and calibre would not find it either.
+"""
+
+import re
+import mmap
+import struct
+import zipfile
+import datetime
+import posixpath
+import xml.etree.ElementTree as ET
+
+import dateutil.parser
+
+_EXTH = {100: 'author', 101: 'publisher', 104: 'isbn',
+         106: 'date', 503: 'title', 524: 'language'}
+
+def clean_isbn(isbn):
+    """
+    >>> clean_isbn(u'urn:isbn:978-0-06-124189-5')
+    '9780061241895'
+    >>> clean_isbn(u'B000FC1PJI') is None
+    True
+    """
+    isbn = re.sub(r'[^\dXx]', '', isbn.lower().replace(u'urn:isbn:', u''))
+    if len(isbn) in (10, 13):
+        return str(isbn.upper())
+    return None
+
+def valid_isbn(isbn):
+    """Whether isbn, as given by clean_isbn, has a right check digit.
+
+    >>> valid_isbn('9780061241895'), valid_isbn('0061241903')
+    (True, True)
+    >>> valid_isbn('9780061241896'), valid_isbn('1234567890')
+    (False, False)
+    """
+    if not isbn or 'X' in isbn[:-1]:
+        return False
+    digits = [10 if c == 'X' else int(c) for c in isbn]
+    if len(digits) == 10:
+        return sum((10 - i) * d for i, d in enumerate(digits)) % 11 == 0
+    if len(digits) == 13 and digits[-1] != 10:
+        return sum(d * (3 if i % 2 else 1)
+                   for i, d in enumerate(digits)) % 10 == 0
+    return False
+
+def parse_date(date):
+    try:
+        return dateutil.parser.parse(date)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+def make_meta(fields):
+    """Turns the raw fields read from a book into the metadata shape of
+    guess_meta, dropping the empty ones.
+
+    >>> sorted(make_meta({'title': u' Influence ', 'author': [u'Robert B. Cialdini'],
+    ...                   'date': u'2006-12-26', 'isbn': u'978-0061241895',
+    ...                   'publisher': u''}).items())
+    [('author', [u'Cialdini, Robert B.']), ('date', datetime.datetime(2006, 12, 26, 0, 0)), ('isbn', '9780061241895'), ('title', u'Influence')]
+    """
+    from docmeta import parse_author
+    meta = {}
+    for field, value in fields.items():
+        if isinstance(value, basestring):
+            value = unicode(value).strip()
+        if not value:
+            continue
+        if field == 'author':
+            authors = []
+            for author in value:
+                authors.extend(parse_author(author))
+            value = [a for a in authors if a]
+        elif field == 'date' and isinstance(value, basestring):
+            value = parse_date(value)
+        elif field == 'isbn':
+            value = clean_isbn(value)
+        if value:
+            meta[field] = value
+    return meta
+
+
+## MOBI
+
+def mobi_fields(data):
+    """Raw fields from the EXTH header of the MOBI file in data, or
+    None if it is not a MOBI file.
+    """
+    if data[60:68] not in ('BOOKMOBI', 'TEXtREAd'):
+        return None
+    record0 = struct.unpack_from('>I', data, 78)[0]
+    if data[record0 + 16:record0 + 20] != 'MOBI':
+        return None
+    mobi = record0 + 16
+    header_length, _, encoding = struct.unpack_from('>III', data, mobi + 4)
+    codec = 'utf-8' if encoding == 65001 else 'cp1252'
+    name_offset, name_length = struct.unpack_from('>II', data, mobi + 68)
+    fields = {'author': []}
+    name = data[record0 + name_offset:record0 + name_offset + name_length]
+    fields['title'] = name.decode(codec, 'replace')
+    exth_flags = struct.unpack_from('>I', data, mobi + 112)[0]
+    exth = mobi + header_length
+    if exth_flags & 0x40 and data[exth:exth + 4] == 'EXTH':
+        count = struct.unpack_from('>I', data, exth + 8)[0]
+        pos = exth + 12
+        for i in xrange(count):
+            kind, length = struct.unpack_from('>II', data, pos)
+            if length < 8:
+                break
+            if kind in _EXTH:
+                value = data[pos + 8:pos + length].decode(codec, 'replace')
+                if kind == 100:
+                    fields['author'].append(value)
+                else:
+                    fields[_EXTH[kind]] = value
+            pos += length
+    return fields
+
+
+## EPUB
+
+_DC = '{http://purl.org/dc/elements/1.1/}'
+_OPF = '{http://www.idpf.org/2007/opf}'
+_CONTAINER = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+
+def opf_path(zf):
+    """Path inside the zip of the OPF package document.
+    """
+    container = ET.fromstring(zf.read('META-INF/container.xml'))
+    for rootfile in container.iter(_CONTAINER + 'rootfile'):
+        return rootfile.get('full-path')
+    return None
+
+def opf_fields(opf):
+    """Raw fields from the metadata of the OPF document opf (a string).
+
+    >>> sorted(opf_fields(
+    ...     '<package xmlns="http://www.idpf.org/2007/opf"'
+    ...     ' xmlns:dc="http://purl.org/dc/elements/1.1/"><metadata>'
+    ...     '<dc:title>Influence</dc:title>'
+    ...     '<dc:creator>Robert B. Cialdini</dc:creator>'
+    ...     '<dc:identifier>urn:isbn:9780061241895</dc:identifier>'
+    ...     '<dc:date>2006-12-26</dc:date></metadata></package>').items())
+    [('author', ['Robert B. Cialdini']), ('date', '2006-12-26'), ('isbn', 'urn:isbn:9780061241895'), ('title', 'Influence')]
+
+    An identifier with no scheme is taken as the ISBN if it is a valid
+    one:
+
+    >>> opf_fields(
+    ...     '<package xmlns="http://www.idpf.org/2007/opf"'
+    ...     ' xmlns:dc="http://purl.org/dc/elements/1.1/"><metadata>'
+    ...     '<dc:identifier>1234567890</dc:identifier>'
+    ...     '<dc:identifier>978-0-06-124189-5</dc:identifier>'
+    ...     '</metadata></package>')['isbn']
+    '978-0-06-124189-5'
+    """
+    metadata = ET.fromstring(opf).find(_OPF + 'metadata')
+    if metadata is None:
+        return None
+    fields = {'author': []}
+    for element in metadata:
+        tag = element.tag
+        text = (element.text or u'').strip()
+        if not tag.startswith(_DC) or not text:
+            continue
+        tag = tag[len(_DC):]
+        if tag == 'creator':
+            if element.get(_OPF + 'role', 'aut') == 'aut':
+                fields['author'].append(text)
+        elif tag == 'identifier':
+            scheme = element.get(_OPF + 'scheme', '').lower()
+            if 'isbn' in fields:
+                continue
+            if scheme == 'isbn' or text.lower().startswith('urn:isbn:'):
+                fields['isbn'] = text
+            elif (not scheme and re.match(r'[\dXx -]+$', text) and
+                  valid_isbn(clean_isbn(text))):
+                fields['isbn'] = text
+        elif tag in ('title', 'publisher', 'language'):
+            fields.setdefault(tag, text)
+        elif tag == 'date':
+            ## Prefer the publication date to the others.
+            event = element.get(_OPF + 'event', 'publication')
+            if event == 'publication' or 'date' not in fields:
+                fields['date'] = text
+    return fields
+
+def epub_fields(fname):
+    with zipfile.ZipFile(fname) as zf:
+        path = opf_path(zf)
+        if path is None:
+            return None
+        return opf_fields(zf.read(posixpath.normpath(path)))
+
+
+## PDF
+
+_PDF_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'f': '\f',
+                '(': '(', ')': ')', '\\': '\\'}
+
+def pdf_string(data, pos):
+    """The PDF string (literal or hexadecimal) that starts at data[pos],
+    decoded.
+
+    >>> pdf_string('(Caf\\\\351 \\\\(au lait\\\\))', 0)
+    u'Caf\\xe9 (au lait)'
+    >>> pdf_string('<FEFF00490074>', 0)
+    u'It'
+    """
+    if data[pos] == '<':
+        end = data.find('>', pos)
+        hexa = re.sub(r'\s', '', data[pos + 1:end])
+        raw = (hexa + '0' * (len(hexa) % 2)).decode('hex')
+    else:
+        out = []
+        depth = 0
+        i = pos + 1
+        while True:
+            c = data[i]
+            if c == '\\':
+                n = data[i + 1]
+                if n in _PDF_ESCAPES:
+                    out.append(_PDF_ESCAPES[n])
+                    i += 2
+                elif n in '01234567':
+                    octal = re.match(r'[0-7]{1,3}', data[i + 1:i + 4]).group()
+                    out.append(chr(int(octal, 8) & 0xff))
+                    i += 1 + len(octal)
+                else:
+                    ## Line continuation, or an escape that means nothing.
+                    i += 2 if n not in '\r\n' else 2 + (data[i + 1:i + 3] == '\r\n')
+                continue
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                if not depth:
+                    break
+                depth -= 1
+            out.append(c)
+            i += 1
+        raw = ''.join(out)
+    if raw.startswith('\xfe\xff'):
+        return raw[2:].decode('utf-16-be', 'replace')
+    return raw.decode('latin-1')
+
+def pdf_date(date):
+    """
+    >>> pdf_date(u"D:20061226083000+01'00'")
+    datetime.datetime(2006, 12, 26, 8, 30)
+    """
+    m = re.match(r'(?:D:)?(\d{4})(\d\d)?(\d\d)?(\d\d)?(\d\d)?(\d\d)?', date)
+    if not m:
+        return None
+    parts = [int(p) if p else d for p, d in zip(m.groups(),
+                                                 (0, 1, 1, 0, 0, 0))]
+    try:
+        return datetime.datetime(*parts)
+    except ValueError:
+        return None
+
+def pdf_info(data):
+    """Raw fields from the Info dictionary of the PDF in data, or None
+    if it cannot be found (e.g. it is in a compressed object stream).
+    """
+    refs = list(re.finditer(r'/Info\s+(\d+)\s+(\d+)\s+R', data))
+    if not refs:
+        return None
+    num, gen = refs[-1].groups()
+    objs = list(re.finditer(r'(?<!\d)%s\s+%s\s+obj\s*<<' % (num, gen), data))
+    if not objs:
+        return None
+    start = objs[-1].end()
+    end = data.find('>>', start)
+    body = data[start:end]
+    fields = {}
+    for key, field in (('Title', 'title'), ('Author', 'author'),
+                       ('CreationDate', 'date')):
+        m = re.search(r'/%s\s*([(<])' % key, body)
+        if not m:
+            continue
+        ## The string can hold '>>', read it from the whole data.
+        value = pdf_string(data, start + m.start(1))
+        if field == 'author':
+            value = [value]
+        elif field == 'date':
+            value = pdf_date(value)
+        fields[field] = value
+    return fields
+
+_XMP_FIELDS = (('title', '{%s}title' % _DC[1:-1]),
+               ('author', '{%s}creator' % _DC[1:-1]),
+               ('publisher', '{%s}publisher' % _DC[1:-1]),
+               ('language', '{%s}language' % _DC[1:-1]))
+_RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+
+def xmp_fields(data):
+    """Raw fields from the XMP packet of the PDF in data, if it has an
+    uncompressed one.
+    """
+    start = data.rfind('<x:xmpmeta')
+    end = data.find('</x:xmpmeta>', start)
+    if start < 0 or end < 0:
+        return {}
+    try:
+        root = ET.fromstring(data[start:end + len('</x:xmpmeta>')])
+    except ET.ParseError:
+        return {}
+    fields = {}
+    for description in root.iter(_RDF + 'Description'):
+        for field, tag in _XMP_FIELDS:
+            for element in description.iter(tag):
+                values = [li.text for li in element.iter(_RDF + 'li')
+                          if li.text] or [element.text]
+                values = [v for v in values if v and v.strip()]
+                if values:
+                    fields[field] = values if field == 'author' else values[0]
+        for key, value in description.attrib.items() + \
+                [(e.tag, e.text) for e in description]:
+            if not value:
+                continue
+            if key.endswith('}CreateDate') and 'date' not in fields:
+                fields['date'] = value
+            elif key.endswith('}isbn') or key.endswith('}ISBN'):
+                fields['isbn'] = value
+    return fields
+
+def pdf_fields(fname):
+    with open(fname, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        info = pdf_info(data)
+        xmp = xmp_fields(data)
+    finally:
+        data.close()
+    ## Without the Info dictionary (e.g. it is in a compressed object
+    ## stream) calibre might know better, unless the XMP packet has
+    ## the essentials.
+    if info is None and not ('title' in xmp and 'author' in xmp):
+        return None
+    ## The XMP packet, when there is one, is the more recent.
+    fields = info or {}
+    fields.update(xmp)
+    return fields
+
+
+def read_meta(fname):
+    """Metadata of the book in fname, in the shape of
+    docmeta.guess_meta, or None if it cannot be read natively.
+    """
+    try:
+        with open(fname, 'rb') as f:
+            head = f.read(78)
+        if head[60:68] in ('BOOKMOBI', 'TEXtREAd'):
+            with open(fname, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                fields = mobi_fields(data)
+            finally:
+                data.close()
+        elif head.startswith('PK') and zipfile.is_zipfile(fname):
+            fields = epub_fields(fname)
+        elif head.startswith('%PDF'):
+            fields = pdf_fields(fname)
+        else:
+            return None
+    except (IOError, OSError, struct.error, IndexError, KeyError,
+            ValueError, zipfile.BadZipfile, ET.ParseError):
+        return None
+    if fields is None:
+        return None
+    return make_meta(fields)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Index of what an org file already contains: hashes of the bodies
+of its quotes and of its paragraphs of text, where the notes are, and
+the set of its Custom_IDs, so that new clippings can be checked
+against it without reading the org file again.
+
+The index is saved next to the other cached state (see orgbib.store)
+together with the size and modification time of the org file.  It is
+updated when clippings are appended, and rebuilt from scratch only
+when the org file has changed in some other way, e.g. edited by hand.
+"""
+
+import os
+import codecs
+import hashlib
+
+from orgbib.store import file_signature, cache_path, load_state, save_state
+
+def quote_key(quote):
+    """Hash of the quote, insensitive to changes in whitespace.
+
+    >>> quote_key(u'So it\\n goes.') == quote_key(u' So it goes. ')
+    True
+    """
+    return hashlib.sha1(u' '.join(quote.split()).encode('utf-8')).digest()
+
+def scan_org(orgfile):
+    """Reads orgfile line by line and returns the keys of its quotes,
+    the set of its Custom_IDs and the keys of its paragraphs outside
+    quotes, drawers and headings.  Drawers and blocks may be indented.
+
+    >>> import tempfile
+    >>> fd, orgfile = tempfile.mkstemp(suffix='.org')
+    >>> os.close(fd)
+    >>> with open(orgfile, 'w') as f:
+    ...     f.write('** Book\\n  :PROPERTIES:\\n'
+    ...             '  :CUSTOM_ID: smith-2001--book\\n  :END:\\n'
+    ...             '  A note.\\n\\n'
+    ...             '  #+BEGIN_QUOTE\\n  So it goes.\\n  #+END_QUOTE\\n')
+    >>> quotes, ids, notes = scan_org(orgfile)
+    >>> ids, quote_key(u'So it goes.') in quotes, len(notes)
+    (set([u'smith-2001--book']), True, 1)
+    >>> quote_key(u'A note.') in notes
+    True
+    >>> os.remove(orgfile)
+    """
+    quotes, ids, notes = set(), set(), set()
+    quote = None
+    paragraph = []
+    with codecs.open(orgfile, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip(u'\n')
+            lower = line.strip().lower()
+            if quote is None and lower and not lower[0] in u'*:#':
+                paragraph.append(line)
+                continue
+            if paragraph:
+                notes.add(quote_key(u'\n'.join(paragraph)))
+                paragraph = []
+            if quote is not None:
+                if lower.startswith(u'#+end_quote'):
+                    if quote:
+                        quotes.add(quote_key(u'\n'.join(quote)))
+                    quote = None
+                else:
+                    quote.append(line)
+            elif lower.startswith(u'#+begin_quote'):
+                quote = []
+            elif lower.startswith(u':custom_id: '):
+                ids.add(line.strip()[len(u':custom_id: '):].strip())
+    if paragraph:
+        notes.add(quote_key(u'\n'.join(paragraph)))
+    return quotes, ids, notes
+
+
+class OrgIndex(object):
+    def __init__(self, orgfile, index_file=None):
+        self.orgfile = orgfile
+        self.index_file = index_file or cache_path('org', orgfile)
+        self.quotes, self.ids, self.notes = set(), set(), set()
+        self.signature = None
+        self.refresh()
+
+    def refresh(self):
+        """Makes sure the index matches the org file, loading it from
+        disk or rebuilding it if needed.
+        """
+        signature = file_signature(self.orgfile)
+        if signature == self.signature:
+            return
+        state = load_state(self.index_file)
+        if signature is None:
+            self.quotes, self.ids, self.notes = set(), set(), set()
+        elif (state and state['signature'] == signature and
+              'notes' in state):
+            self.quotes, self.ids, self.notes = (state['quotes'],
+                                                 state['ids'], state['notes'])
+        else:
+            self.quotes, self.ids, self.notes = scan_org(self.orgfile)
+            self.save(signature)
+        self.signature = signature
+
+    def save(self, signature):
+        save_state(self.index_file, {'signature': signature,
+                                     'quotes': self.quotes,
+                                     'ids': self.ids,
+                                     'notes': self.notes})
+
+    def has_quote(self, quote):
+        return quote_key(quote) in self.quotes
+
+    def has_id(self, custom_id):
+        return custom_id in self.ids
+
+    def has_note(self, note):
+        return quote_key(note) in self.notes
+
+    def appended(self, quotes=(), ids=(), notes=()):
+        """Records the quotes, Custom_IDs and notes just written to the
+        org file.
+        """
+        self.quotes.update(quote_key(q) for q in quotes)
+        self.ids.update(ids)
+        self.notes.update(quote_key(n) for n in notes)
+        self.signature = file_signature(self.orgfile)
+        self.save(self.signature)
+
+
+_shared = {}
+
+def shared_index(orgfile):
+    """The OrgIndex of orgfile, shared by everybody in the process.
+    """
+    key = os.path.abspath(orgfile)
+    if key not in _shared:
+        _shared[key] = OrgIndex(orgfile)
+    else:
+        _shared[key].refresh()
+    return _shared[key]
@@ -2,10 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import collections
+import datetime
 import os
-import codecs
+import hashlib
 import re
 
+try:
+    import dateutil.parser
+except ImportError:
+    dateutil = None
+
+from orgbib.store import file_signature, cache_path, load_state, save_state
+
+Meta = collections.namedtuple('Meta', 'kind page loc when')
+
 def parse_loc(loc):
     """Parse the location.  Useful to locate notes (single-value
     location) using adjacent highlights (range location and text to
@@ -27,13 +37,75 @@ def parse_loc(loc):
     end = int(start[0:-digits] + '0' * digits) + int(loc[1])
     return int(start), end
 
+_MONTHS = dict((month, i + 1) for i, month in
+               enumerate(['January', 'February', 'March', 'April', 'May',
+                          'June', 'July', 'August', 'September', 'October',
+                          'November', 'December']))
+
+## The two layouts Kindle has used for the 'Added on' date.
+_ADDED_ON_RE = re.compile(r'\w+, (\w+) (\d{1,2}), (\d{4}),? '
+                          r'(\d{1,2}):(\d\d)(?::(\d\d))? ([AP]M)$')
+
+_added_on_cache = {}
+
+def parse_added_on(when):
+    """Parses the date of the 'Added on' field, using dateutil only for
+    the layouts it does not know about.  Returns None if it cannot be
+    parsed.  Kindle writes many clippings per minute, so the results
+    are memoized.
+
+    >>> parse_added_on('Tuesday, June 05, 2012, 11:43 PM')
+    datetime.datetime(2012, 6, 5, 23, 43)
+    >>> parse_added_on('Saturday, August 2, 2014 12:16:19 AM')
+    datetime.datetime(2014, 8, 2, 0, 16, 19)
+    >>> parse_added_on('Thursday, 1 January 2015 09:03:11')
+    datetime.datetime(2015, 1, 1, 9, 3, 11)
+    >>> parse_added_on('Tuesday, February 30, 2012, 11:43 PM') is None
+    True
+    """
+    if when in _added_on_cache:
+        return _added_on_cache[when]
+    parsed = None
+    m = _ADDED_ON_RE.match(when)
+    if m and m.group(1) in _MONTHS:
+        month, day, year, hour, minute, second, ampm = m.groups()
+        hour = int(hour) % 12 + (12 if ampm == 'PM' else 0)
+        try:
+            parsed = datetime.datetime(int(year), _MONTHS[month], int(day),
+                                       hour, int(minute), int(second or 0))
+        except ValueError:
+            ## No such date; dateutil will not make sense of it either.
+            pass
+    elif dateutil is not None:
+        try:
+            parsed = dateutil.parser.parse(when)
+        except Exception:
+            pass
+    if len(_added_on_cache) > 100000:
+        _added_on_cache.clear()
+    _added_on_cache[when] = parsed
+    return parsed
+
+## Header lines of the known Kindle layouts: the old one with 'Loc.'
+## and the new one with 'Location', both with and without page.
+_META_RE = re.compile(r'- (?:Your )?(Highlight|Note|Bookmark)'
+                      r'(?: on [Pp]age (\d+) \|)?'
+                      r'(?: (?:on )?(?:Loc\.|Location) (\d+-?\d+) *\|)?'
+                      r' Added on ([^|]*)$')
+
+_KINDS = {'Highlight': 'highlight', 'Note': 'note', 'Bookmark': 'bookmark'}
+
+_PAGE_RE = re.compile(r'[Pp]age (\d+)')
+_LOC_RE = re.compile(r'Loc. (\d+-?\d+)')
+_LOCATION_RE = re.compile(r'Location (\d+-?\d+)')
+
 def parse_metadata(line):
     """Parse the metadata line.
 
     Returns a named tuple with 'kind page loc when' fields.  The
     'kind' field can be either highlight, note or bookmark.  The
-    'when' field is a datetime object if the dateutil library was
-    available, None otherwise.
+    'when' field is a datetime object if the date could be parsed,
+    None otherwise.
 
     >>> parse_metadata('- Highlight Loc. 631-32  | Added on Tuesday, June 05, 2012, 11:43 PM')
     Meta(kind='highlight', page=None, loc=(631, 632), when=datetime.datetime(2012, 6, 5, 23, 43))
@@ -47,6 +119,25 @@ def parse_metadata(line):
     Meta(kind='bookmark', page=137, loc=(2396,), when=datetime.datetime(2011, 9, 18, 22, 37))
     >>> parse_metadata('- Your Highlight on page 122 | Location 2184-2188 | Added on Saturday, August 2, 2014 8:16:19 PM')
     Meta(kind='highlight', page=122, loc=(2184, 2188), when=datetime.datetime(2014, 8, 2, 20, 16, 19))
+    >>> parse_metadata('- Your Note on Location 45 | Added on Saturday, August 2, 2014 8:16:19 PM')
+    Meta(kind='note', page=None, loc=(45,), when=datetime.datetime(2014, 8, 2, 20, 16, 19))
+    >>> parse_metadata('- Your Highlight on page 12 | Added on Saturday, August 2, 2014 8:16:19 PM')
+    Meta(kind='highlight', page=12, loc=None, when=datetime.datetime(2014, 8, 2, 20, 16, 19))
+    >>> parse_metadata('- Your Highlight at location 12-14 | Added on Thursday, 1 January 2015 09:03:11')
+    Meta(kind='highlight', page=None, loc=None, when=datetime.datetime(2015, 1, 1, 9, 3, 11))
+    """
+    m = _META_RE.match(line)
+    if m:
+        kind, page, loc, when = m.groups()
+        return Meta(_KINDS[kind],
+                    int(page) if page else None,
+                    parse_loc(loc) if loc else None,
+                    parse_added_on(when.strip()))
+    return _parse_metadata_generic(line)
+
+def _parse_metadata_generic(line):
+    """Slow path of parse_metadata, for header lines that do not
+    follow any of the known layouts.
     """
     if '- Highlight' in line or '- Your Highlight' in line:
         kind = 'highlight'
@@ -59,72 +150,318 @@ def parse_metadata(line):
     line = line.split('|')
 
     page = None
-    m = re.search(r'[Pp]age (\d+)', line[0])
+    m = _PAGE_RE.search(line[0])
     if m:
         page = int(m.group(1))
 
     loc = None
-    m = re.search(r'Loc. (\d+-?\d+)', line[-2])
+    m = _LOC_RE.search(line[-2])
     if m:
         loc = parse_loc(m.group(1))
     else:
-        m = re.search(r'Location (\d+-?\d+)', line[-2])
+        m = _LOCATION_RE.search(line[-2])
         if m:
             loc = parse_loc(m.group(1))
 
     when = None
     if 'Added on' in line[-1]:
-        try:
-            import dateutil.parser
-            when = dateutil.parser.parse(line[-1][9:])
-        except:
-            pass
-    Meta = collections.namedtuple('Meta', 'kind page loc when')
+        when = parse_added_on(line[-1][9:].strip())
     return Meta(kind, page, loc, when)
 
-def parse_clippings(clips_file):
-    """Reads a kindle clippings file and returns a dictionary indexed by book
-    name whose values are arrays of clippings.
+SEPARATOR = '=========='
+
+Clipping = collections.namedtuple('Clipping', 'book text meta end')
+
+def iter_sections(f, offset=0, chunk_size=1 << 16):
+    """Reads the open file f in chunks, from offset on, and yields its
+    sections as (bytes, end) pairs, where end is the offset just after
+    the section's separator.  The last section, if not terminated by a
+    separator, comes with end None.
+
+    >>> import StringIO
+    >>> f = StringIO.StringIO('a\\n==========\\nbc\\n==========\\nd')
+    >>> list(iter_sections(f, chunk_size=4))
+    [('a\\n', 12), ('\\nbc\\n', 26), ('\\nd', None)]
+    >>> list(iter_sections(f, offset=12))
+    [('\\nbc\\n', 26), ('\\nd', None)]
     """
-    with codecs.open(clips_file, 'r', encoding="utf-8") as f:
-        content = f.read()
+    f.seek(offset)
+    buf = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        start = max(0, len(buf) - len(SEPARATOR) + 1)
+        buf += chunk
+        i = buf.find(SEPARATOR, start)
+        while i >= 0:
+            offset += i + len(SEPARATOR)
+            yield buf[:i], offset
+            buf = buf[i + len(SEPARATOR):]
+            i = buf.find(SEPARATOR)
+    if buf:
+        yield buf, None
+
+def parse_section(section):
+    """Parses the bytes of a section of the clippings file.  Returns a
+    (book, text, meta) tuple, or None if the section is not a
+    clipping.
 
+    >>> parse_section('\\xef\\xbb\\xbfBook (A)\\r\\n- Note Loc. 631  | Added on Tuesday, June 05, 2012, 11:45 PM\\r\\n\\r\\nA note\\r\\n')
+    (u'Book (A)', u'A note', Meta(kind='note', page=None, loc=(631,), when=datetime.datetime(2012, 6, 5, 23, 45)))
+    """
     ## Deprecated zero-width no-break unicode space
-    content = content.replace(u'\ufeff', u'')
+    section = section.replace('\xef\xbb\xbf', '')
 
     # At some point it started coming with \r that mess everything up
-    content = content.replace(u'\r','')
+    section = section.replace('\r', '')
+
+    lines = [l for l in section.decode('utf-8').split(u'\n') if l]
+    if len(lines) >= 3:
+        meta = parse_metadata(lines[1])
+        if meta is not None:
+            return lines[0], u'\n'.join(lines[2:]), meta
+    return None
+
+def iter_clippings(clips_file, offset=0, chunk_size=1 << 16):
+    """Yields the clippings in clips_file, from the section starting
+    at byte offset on, as Clipping records.  The file is read in
+    chunks, so memory use does not depend on its size.  The end field
+    of each record is the offset at which the next section starts, or
+    None if the clipping is not terminated yet.
+    """
+    with open(clips_file, 'rb') as f:
+        for section, end in iter_sections(f, offset, chunk_size):
+            parsed = parse_section(section)
+            if parsed is not None:
+                yield Clipping(parsed[0], parsed[1], parsed[2], end)
+
+def add_clipping(clips, clipping):
+    """Adds a clipping to the dictionary of clippings by book.
+    """
+    book, text, meta = clipping[:3]
+    if meta.kind == 'note':
+        ## We associate notes to the previous highlight.
+        clips[book][-1][2] = text
+    else:
+        clips[book].append([text, meta, ''])
+
+def prefix_fingerprint(f, offset, block=1 << 16):
+    """Hash identifying the first offset bytes of the open file f.  It
+    only looks at the first and last blocks of that prefix, which is
+    enough to notice that an append-only file has been replaced or
+    truncated without reading all of it.
+    """
+    h = hashlib.sha1(str(offset))
+    f.seek(0)
+    h.update(f.read(min(block, offset)))
+    f.seek(max(0, offset - block))
+    h.update(f.read(min(block, offset)))
+    return h.hexdigest()
+
+def parse_new(clips_file, clips, offset):
+    """Adds to clips the terminated clippings of clips_file from byte
+    offset on.  Returns the offset up to which they were added and the
+    last clipping, if Kindle has not finished writing it yet.
+    """
+    unterminated = None
+    parsed_to = offset
+    for clipping in iter_clippings(clips_file, offset):
+        if clipping.end is None:
+            unterminated = clipping
+        else:
+            add_clipping(clips, clipping)
+            parsed_to = clipping.end
+    return parsed_to, unterminated
+
+def save_checkpoint(checkpoint, clips_file, clips, offset):
+    with open(clips_file, 'rb') as f:
+        fingerprint = prefix_fingerprint(f, offset)
+    save_state(checkpoint, {'source': os.path.abspath(clips_file),
+                            'offset': offset,
+                            'fingerprint': fingerprint,
+                            'clips': clips})
+
+def read_clippings(clips_file, checkpoint=None):
+    """Like parse_clippings, but also returns the offset up to which
+    the clippings were parsed, and whether the last, unterminated one
+    was added to them.
+    """
+    clips, offset = None, 0
+    state = load_state(checkpoint) if checkpoint else None
+    if state and state.get('source') == os.path.abspath(clips_file):
+        with open(clips_file, 'rb') as f:
+            if (os.fstat(f.fileno()).st_size >= state['offset'] and
+                prefix_fingerprint(f, state['offset']) ==
+                state['fingerprint']):
+                clips, offset = state['clips'], state['offset']
+    if clips is None:
+        clips = collections.defaultdict(list)
 
-    clips = collections.defaultdict(list)
-    for section in content.split(u"=========="):
-        lines = [l for l in section.split(u'\n') if l]
-        if len(lines) >= 3:
-            book, what = lines[0], lines[1]
-            content = '\n'.join(lines[2:])
-            meta = parse_metadata(what)
-            if meta is not None:
-                if meta.kind == 'note':
-                    ## We associate notes to the previous highlight.
-                    clips[book][-1][2] = content
-                else:
-                    clips[book].append([content, meta, ''])
+    ## Only terminated clippings go into the checkpoint; Kindle might
+    ## still be writing the last one.
+    parsed_to, unterminated = parse_new(clips_file, clips, offset)
+    if checkpoint and parsed_to > offset:
+        save_checkpoint(checkpoint, clips_file, clips, parsed_to)
+    if unterminated is not None:
+        add_clipping(clips, unterminated)
+    return clips, parsed_to, unterminated is not None
+
+def parse_clippings(clips_file, checkpoint=None):
+    """Reads a kindle clippings file and returns a dictionary indexed by book
+    name whose values are arrays of clippings.
+
+    If checkpoint is given it is the file where the parsed clippings
+    are kept, together with the byte offset of the last clipping they
+    include.  Kindle only appends to the clippings file, so the next
+    call only parses what was added since, unless the part that had
+    already been parsed has changed.
+    """
+    return read_clippings(clips_file, checkpoint)[0]
+
+
+def clippings_source(clips_file, bu_clips_file=None):
+    """The file the clippings will be read from: the main clippings
+    file if it exists, otherwise its backup (which might not exist
+    either).
+    """
+    if clips_file and os.path.exists(clips_file):
+        return clips_file
+    return bu_clips_file
 
-    return clips
+
+class TitleIndex(object):
+    """Trigram index over book names, to find the first name (in the
+    order they were added) that contains a given string without
+    looking at all of them.
+
+    >>> ti = TitleIndex([u'Influence (Cialdini, Robert B.)',
+    ...                  u'Adapt: Why Success Always Starts with Failure'])
+    >>> ti.first_containing(u'Adapt')
+    u'Adapt: Why Success Always Starts with Failure'
+    >>> ti.first_containing(u'influence') is None
+    True
+    >>> ti.first_containing(u'influence', ignore_case=True)
+    u'Influence (Cialdini, Robert B.)'
+    """
+    def __init__(self, names=()):
+        self.names = []
+        self.grams = collections.defaultdict(set)
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        pos = len(self.names)
+        self.names.append(name)
+        name = name.lower()
+        for i in xrange(len(name) - 2):
+            self.grams[name[i:i+3]].add(pos)
+
+    def candidates(self, lc):
+        """Positions of the names whose lower-cased version might
+        contain lc, in order.
+        """
+        if len(lc) < 3:
+            return xrange(len(self.names))
+        postings = sorted((self.grams.get(lc[i:i+3], ())
+                           for i in xrange(len(lc) - 2)), key=len)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            if not found:
+                break
+            found &= posting
+        return sorted(found)
+
+    def first_containing(self, s, ignore_case=False):
+        lc = s.lower()
+        for pos in self.candidates(lc):
+            name = self.names[pos]
+            if (lc in name.lower()) if ignore_case else (s in name):
+                return name
+        return None
 
 
 class Clippings(object):
-    def __init__(self, clips_file, bu_clips_file=None):
-        parse_from = bu_clips_file
-        if os.path.exists(clips_file):
-            parse_from = clips_file
-            if bu_clips_file:
-                import shutil
-                shutil.copy(clips_file, bu_clips_file)
-        if os.path.exists(parse_from):
-            self.clips = parse_clippings(parse_from)
+    """The clippings of a Kindle clippings file, by book.
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> clips_file = os.path.join(tmp, 'My Clippings.txt')
+    >>> clipping = ('%s\\n- Highlight Loc. 631-32  | Added on Tuesday, '
+    ...             'June 05, 2012, 11:43 PM\\n\\n%s\\n==========\\n')
+    >>> with open(clips_file, 'w') as f: f.write(clipping % ('A', 'one'))
+    >>> kc = Clippings(clips_file)
+    >>> with open(clips_file, 'a') as f: f.write(clipping % ('B', 'two'))
+    >>> kc.update()
+    True
+    >>> [(book, len(kc.list_book(book))) for book in kc.list_book_titles()]
+    [(u'A', 1), (u'B', 1)]
+    >>> with open(clips_file, 'w') as f: f.write(clipping % ('C', 'three'))
+    >>> kc.update()
+    False
+    >>> shutil.rmtree(tmp)
+    """
+    def __init__(self, clips_file, bu_clips_file=None, checkpoint=None):
+        self.clips_file = clips_file
+        self.bu_clips_file = bu_clips_file
+        self.checkpoint = checkpoint
+        parse_from = clippings_source(clips_file, bu_clips_file)
+        self.backup()
+        self.signature = (parse_from, file_signature(parse_from))
+        ## Where to go on parsing from, None if the file has to be
+        ## parsed again: the last clipping was not terminated.
+        self.offset = None
+        if parse_from and os.path.exists(parse_from):
+            self.clips, offset, partial = read_clippings(parse_from,
+                                                         checkpoint)
+            if not partial:
+                self.offset = offset
+                with open(parse_from, 'rb') as f:
+                    self.fingerprint = prefix_fingerprint(f, offset)
         else:
             print "** Warning, no clippings file found."
             self.clips = {}
+        self.titles = TitleIndex(self.clips.keys())
+        self.full_names = {}
+
+    def backup(self):
+        if self.clips_file and self.bu_clips_file and \
+               clippings_source(self.clips_file) == self.clips_file:
+            import shutil
+            shutil.copy(self.clips_file, self.bu_clips_file)
+
+    def update(self):
+        """Adds the clippings appended to the file since it was last
+        read, keeping the ones already parsed.  Returns False, doing
+        nothing, if it cannot: the file has been replaced, truncated or
+        edited, or it is not the one the clippings were read from.
+        """
+        parse_from = clippings_source(self.clips_file, self.bu_clips_file)
+        if self.offset is None or parse_from != self.signature[0]:
+            return False
+        with open(parse_from, 'rb') as f:
+            if (os.fstat(f.fileno()).st_size < self.offset or
+                prefix_fingerprint(f, self.offset) != self.fingerprint):
+                return False
+        self.backup()
+        books = set(self.clips)
+        offset, unterminated = parse_new(parse_from, self.clips, self.offset)
+        if offset > self.offset and self.checkpoint:
+            save_checkpoint(self.checkpoint, parse_from, self.clips, offset)
+        if unterminated is not None:
+            add_clipping(self.clips, unterminated)
+            self.offset = None
+        else:
+            with open(parse_from, 'rb') as f:
+                self.fingerprint = prefix_fingerprint(f, offset)
+            self.offset = offset
+        for book in self.clips:
+            if book not in books:
+                self.titles.add(book)
+        ## Titles that were not found might be now.
+        self.full_names = {}
+        self.signature = (parse_from, file_signature(parse_from))
+        return True
 
     def list_book_titles(self):
         return sorted(self.clips.keys())
@@ -132,16 +469,13 @@ class Clippings(object):
     def book_full_name(self, title):
         if title in self.clips:
             return title
-        title = title.split(':')[0]
-        for k in self.clips.keys():
-            if title in k:
-                return k
-
-        titlelc = title.lower()
-        for k in self.clips.keys():
-            if titlelc in k.lower():
-                return k
-        return title
+        if title not in self.full_names:
+            short = title.split(':')[0]
+            self.full_names[title] = (
+                self.titles.first_containing(short) or
+                self.titles.first_containing(short, ignore_case=True) or
+                short)
+        return self.full_names[title]
 
     def list_book(self, title):
         full_name = self.book_full_name(title)
@@ -150,6 +484,26 @@ class Clippings(object):
         else:
             return []
 
+_shared = {}
+
+def shared_clippings(clips_file, bu_clips_file=None):
+    """Returns the Clippings for clips_file (or its backup), shared by
+    everybody in the process.  The file is parsed the first time it
+    is asked for; when its size or modification time change, only the
+    clippings appended since are parsed, if it has only been appended
+    to, and all of it otherwise.  The parsed clippings are checkpointed
+    between runs, so that only new clippings are parsed.
+    """
+    parse_from = clippings_source(clips_file, bu_clips_file)
+    signature = (parse_from, file_signature(parse_from))
+    key = (clips_file, bu_clips_file)
+    kc = _shared.get(key)
+    if kc is None or (kc.signature != signature and not kc.update()):
+        checkpoint = parse_from and cache_path('clippings', parse_from)
+        kc = _shared[key] = Clippings(clips_file, bu_clips_file,
+                                      checkpoint)
+    return kc
+
 def _test():
     import doctest
     doctest.testmod()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Run items through a sequence of stages, each with its own pool of
+worker threads, so that different items can be in different stages
+at the same time: while one book is being converted to mobi, the
+metadata of the next ones is read and the text of the previous one
+is extracted.
+
+The stages are connected by queues.  Each stage has its own number of
+workers and its own timeout, given to the calibre calls made by its
+workers (see orgbib.calibre), which kills hung calibre processes.  An
+item whose stage fails or returns None skips the rest of the
+stages.  The results come out in the order of the items.
+
+>>> import time
+>>> def slow_double(x):
+...     time.sleep(0.01 * (5 - x))
+...     return 2 * x
+>>> p = Pipeline([Stage('double', slow_double, workers=3),
+...               Stage('odd', lambda x: x if x % 4 else None)])
+>>> list(p.run(range(5)))
+[None, 2, None, 6, None]
+"""
+
+import time
+import Queue
+import threading
+
+import orgbib.calibre
+
+_DONE = object()
+
+
+class Stage(object):
+    def __init__(self, name, func, workers=1, timeout=None):
+        assert workers >= 1, 'Stage %s without workers' % name
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.timeout = timeout
+
+
+class Pipeline(object):
+    def __init__(self, stages):
+        self.stages = stages
+        self.lock = threading.Lock()
+        ## Number of items and seconds spent on them, by stage.
+        self.busy = dict((stage.name, [0, 0.0]) for stage in stages)
+        ## Seconds spent on each item, by stage.
+        self.latencies = dict((stage.name, []) for stage in stages)
+        self.wall = 0.0
+
+    def work(self, stage, inq, outq, running, downstream):
+        while True:
+            item = inq.get()
+            if item is _DONE:
+                break
+            index, value = item
+            if value is not None:
+                start = time.time()
+                try:
+                    with orgbib.calibre.timeout(stage.timeout):
+                        value = stage.func(value)
+                except Exception, e:
+                    print '** Error in stage %s: %s' % (stage.name, e)
+                    value = None
+                elapsed = time.time() - start
+                with self.lock:
+                    self.busy[stage.name][0] += 1
+                    self.busy[stage.name][1] += elapsed
+                    self.latencies[stage.name].append(elapsed)
+            outq.put((index, value))
+        with self.lock:
+            running[0] -= 1
+            last = not running[0]
+        ## The last worker of the stage tells all of the next one.
+        if last:
+            for i in xrange(downstream):
+                outq.put(_DONE)
+
+    def start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def feed(self, items, queue):
+        for item in enumerate(items):
+            queue.put(item)
+        for i in xrange(self.stages[0].workers):
+            queue.put(_DONE)
+
+    def run(self, items):
+        """Yields the result of running each of the items through all
+        the stages, None for those that did not make it, in the order
+        of items.
+        """
+        start = time.time()
+        queues = [Queue.Queue() for i in xrange(len(self.stages) + 1)]
+        for i, stage in enumerate(self.stages):
+            downstream = (self.stages[i + 1].workers
+                          if i + 1 < len(self.stages) else 1)
+            running = [stage.workers]
+            for w in xrange(stage.workers):
+                self.start(self.work, stage, queues[i], queues[i + 1],
+                           running, downstream)
+        self.start(self.feed, items, queues[0])
+
+        pending = {}
+        next_index = 0
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            pending[item[0]] = item[1]
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+        self.wall = time.time() - start
+
+    def report(self):
+        lines = ['%-6s %2d workers, %3d items, %7.1fs busy' %
+                 (stage.name, stage.workers, self.busy[stage.name][0],
+                  self.busy[stage.name][1]) for stage in self.stages]
+        return '\n'.join(lines + ['%.1fs in total' % self.wall])
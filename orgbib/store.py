@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Small helpers to keep state between runs: where to put it, how to
+tell whether the file it was computed from has changed, and how to
+save it without leaving half-written files around.
+
+The state lives in ~/.cache/orgbib, or in the directory pointed to by
+the ORGBIB_CACHE environment variable.
+"""
+
+import os
+import hashlib
+import cPickle as pickle
+
+
+def cache_dir():
+    return os.path.expanduser(os.environ.get('ORGBIB_CACHE',
+                                             '~/.cache/orgbib'))
+
+def cache_path(kind, fname):
+    """Path of the cache file of the given kind associated to fname.
+    Different files with the same name get different cache files.
+
+    >>> os.path.basename(cache_path('clippings', '/a/b.txt'))
+    'clippings-b.txt-be48de557010.pickle'
+    """
+    key = hashlib.sha1(os.path.abspath(fname)).hexdigest()[:12]
+    return os.path.join(cache_dir(), '%s-%s-%s.pickle' %
+                        (kind, os.path.basename(fname), key))
+
+def file_signature(fname):
+    """Size and modification time of fname, None if it does not exist.
+    """
+    if not fname or not os.path.exists(fname):
+        return None
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime
+
+def load_state(path):
+    """The object saved in path, or None if it cannot be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+def save_state(path, state):
+    """Saves state to path atomically.  Failing to save is not an
+    error, the state is only there to make the next run faster.
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+        return True
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
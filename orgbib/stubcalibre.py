@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""stubcalibre
+By %s
+%s
+
+Stand-ins for calibre's ebook-meta and ebook-convert, to exercise the
+importer at scale without calibre or real books.  They are written to
+a directory; setting ORGBIB_CALIBRE_TOOLS to it makes orgbib use them
+instead of the real ones (see orgbib.calibre).
+
+ebook-meta prints the metadata of the book in the layout of calibre.
+It is taken from the first line of the book, if it is STUB-META
+followed by a JSON object (see stub_book), and made up from the file
+name otherwise.  Writing metadata does nothing.  ebook-convert copies
+the book to a book, and writes made up text, always the same for the
+same book, to a .txt file.
+
+How they behave is set with environment variables, each of which can
+also be given for one of the tools only by appending its name, as in
+ORGBIB_STUB_LATENCY_EBOOK_CONVERT:
+
+ORGBIB_STUB_LATENCY    Seconds each call takes, or a lo-hi range from
+                       which it is drawn (by default 0).
+ORGBIB_STUB_FAILURES   Fraction of the calls that fail (by default 0).
+ORGBIB_STUB_TEXT_KB    Size of the texts written (by default 64).
+
+Usage: python -m orgbib.stubcalibre dir
+"""
+__date__ = "2013-04-29"
+__author__ = "Juan Reyero, http://juanreyero.com"
+
+import os
+import sys
+import json
+
+TOOLS = ['ebook-meta', 'ebook-convert']
+
+STUB = r'''
+import os, sys, time, json, random, hashlib, shutil
+
+name = os.path.basename(sys.argv[0])
+
+def setting(what, default):
+    key = 'ORGBIB_STUB_' + what
+    return os.environ.get(key + '_' + name.upper().replace('-', '_'),
+                          os.environ.get(key, default))
+
+def book_meta(book):
+    with open(book, 'rb') as f:
+        line = f.readline()
+    if line.startswith('STUB-META '):
+        return json.loads(line[len('STUB-META '):])
+    title = os.path.splitext(os.path.basename(book))[0]
+    return {'title': title.replace('-', ' ').title(), 'author': 'Stub Author',
+            'date': '2000-01-01'}
+
+def ebook_meta(args):
+    if len(args) > 1:
+        return 0
+    meta = book_meta(args[0])
+    lines = [('Title', meta['title']),
+             ('Author(s)', ' & '.join(meta['author'])
+              if isinstance(meta['author'], list) else meta['author']),
+             ('Published', meta.get('date', '')),
+             ('Identifiers', 'isbn:' + meta['isbn'] if 'isbn' in meta
+              else '')]
+    for what, value in lines:
+        if value:
+            print ('%-20s: %s' % (what, value)).encode('utf-8')
+    return 0
+
+WORDS = ('the of and to in that was it his had with for as she you her '
+         'at on not but from they this which all were have one been so '
+         'there would what said when out them into could more man very '
+         'time only little like some know now about great upon house '
+         'night long eyes never think after first old door life face '
+         'mind hand room light thought came still looked head world '
+         'voice water morning window garden silence letter river').split()
+
+def ebook_convert(args):
+    src, dst = args[:2]
+    if os.path.splitext(dst)[1] != '.txt':
+        shutil.copy(src, dst)
+        return 0
+    with open(src, 'rb') as f:
+        rnd = random.Random(hashlib.sha1(f.read()).hexdigest())
+    size = int(float(setting('TEXT_KB', '64')) * 1024)
+    out, length = [], 0
+    while length < size:
+        words = [rnd.choice(WORDS) for i in xrange(rnd.randint(8, 30))]
+        sentence = ' '.join(words).capitalize() + '.'
+        out.append(sentence)
+        length += len(sentence) + 1
+    with open(dst, 'w') as f:
+        f.write('\n'.join(out))
+    return 0
+
+latency = setting('LATENCY', '0').split('-')
+time.sleep(random.uniform(float(latency[0]), float(latency[-1])))
+if random.random() < float(setting('FAILURES', '0')):
+    sys.stderr.write('%s: simulated failure\n' % name)
+    sys.exit(1)
+if name == 'ebook-meta':
+    sys.exit(ebook_meta(sys.argv[1:]))
+elif name == 'ebook-convert':
+    sys.exit(ebook_convert(sys.argv[1:]))
+sys.exit(127)
+'''
+
+def install(dirname):
+    """Writes the stand-ins to dirname, and returns it.
+    """
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    for tool in TOOLS:
+        path = os.path.join(dirname, tool)
+        with open(path, 'w') as f:
+            f.write('#!%s\n' % sys.executable + STUB)
+        os.chmod(path, 0755)
+    return dirname
+
+def stub_book(fname, meta, size=0):
+    """Writes a fake book whose metadata, for the stand-in ebook-meta,
+    is meta (a dictionary with title, author and date, and possibly
+    isbn), padded to size bytes.
+    """
+    line = 'STUB-META %s\n' % json.dumps(meta)
+    with open(fname, 'wb') as f:
+        f.write(line)
+        f.write('x' * max(0, size - len(line)))
+
+
+def as_main():
+    if len(sys.argv) != 2 or sys.argv[1] in ('-h', '--help'):
+        print __doc__ % (__author__, __date__)
+        sys.exit(1)
+    print 'export ORGBIB_CALIBRE_TOOLS=%s' % \
+          os.path.abspath(install(sys.argv[1]))
+
+if __name__ == '__main__':
+    as_main()
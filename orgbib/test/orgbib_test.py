@@ -3,12 +3,40 @@
 
 import orgbib.parse
 import orgbib.docid
+import orgbib.store
+import orgbib.locate
+import orgbib.booktext
+import orgbib.orgindex
+import orgbib.bibindex
+import orgbib.metacache
+import orgbib.nativemeta
+import orgbib.epubtext
+import orgbib.textstore
+import orgbib.pipeline
+import orgbib.manifest
+import orgbib.watch
+import orgbib.clipper
+import orgbib.calibre
 
 import unittest, doctest
 
 def suite():
     tests = [doctest.DocTestSuite(orgbib.parse),
-             doctest.DocTestSuite(orgbib.docid)]
+             doctest.DocTestSuite(orgbib.docid),
+             doctest.DocTestSuite(orgbib.store),
+             doctest.DocTestSuite(orgbib.locate),
+             doctest.DocTestSuite(orgbib.booktext),
+             doctest.DocTestSuite(orgbib.orgindex),
+             doctest.DocTestSuite(orgbib.bibindex),
+             doctest.DocTestSuite(orgbib.metacache),
+             doctest.DocTestSuite(orgbib.nativemeta),
+             doctest.DocTestSuite(orgbib.epubtext),
+             doctest.DocTestSuite(orgbib.textstore),
+             doctest.DocTestSuite(orgbib.pipeline),
+             doctest.DocTestSuite(orgbib.manifest),
+             doctest.DocTestSuite(orgbib.watch),
+             doctest.DocTestSuite(orgbib.clipper),
+             doctest.DocTestSuite(orgbib.calibre)]
     return unittest.TestSuite(tests)
 
 if __name__ == '__main__':
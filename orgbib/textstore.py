@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""booktexts
+By %s
+%s
+
+Store of the text versions of books, addressed by the SHA-1 of the
+contents of the book they come from, so that a book is converted only
+once no matter how many times it is imported, under which name or with
+which bibid.  The text/<bibid>.txt files are hard links into the store
+(or copies, if the store is in another file system).
+
+The store lives in the text directory under the cache directory (see
+orgbib.store).  It is kept under a maximum size by removing the least
+recently used texts that nothing links to any more: texts that are
+still linked from a text directory take no space of their own.
+
+Usage: booktexts [options]
+
+Options:
+
+-g, --gc              Remove the least recently used texts that are not
+                      linked from anywhere until the store is under its
+                      maximum size.
+-s n, --size=n        Maximum size of the store, in megabytes (by
+                      default %d).  With --gc, -s 0 removes all the
+                      texts not linked from anywhere.
+-h, --help            This help.
+"""
+__date__ = "2013-04-29"
+__author__ = "Juan Reyero, http://juanreyero.com"
+
+import os
+import time
+import errno
+import shutil
+import tempfile
+import threading
+
+from orgbib.store import cache_dir
+from orgbib.metacache import content_hash
+
+DEFAULT_MAX_MB = 1024
+
+
+class TextStore(object):
+    """Texts addressed by the hash of their source.
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> store = TextStore(os.path.join(tmp, 'store'))
+    >>> def convert(txt):
+    ...     with open(txt, 'w') as f: f.write('text')
+    ...     return True
+    >>> store.get('abc') is None
+    True
+    >>> store.put('abc', convert) == store.get('abc')
+    True
+    >>> store.link('abc', os.path.join(tmp, 'one-2000--book.txt'))
+    True
+    >>> store.entries()[0][1:3]
+    (4, 2)
+    >>> os.remove(os.path.join(tmp, 'one-2000--book.txt'))
+    >>> store.gc(0)
+    1
+    >>> store.get('abc') is None
+    True
+
+    Only the texts not linked from anywhere count towards the maximum
+    size, and the one just stored is never removed to make room:
+
+    >>> store = TextStore(os.path.join(tmp, 'small'), max_bytes=6)
+    >>> def text_for(i):
+    ...     book = os.path.join(tmp, '%d.mobi' % i)
+    ...     with open(book, 'w') as f: f.write(str(i))
+    ...     return store.text_for(book, os.path.join(tmp, '%d.txt' % i),
+    ...                           lambda book, txt: convert(txt))
+    >>> [text_for(i) for i in range(4)]
+    [True, True, True, True]
+    >>> store.size
+    0
+    >>> shutil.rmtree(tmp)
+    """
+    def __init__(self, root, max_bytes=DEFAULT_MAX_MB << 20):
+        self.root = root
+        self.max_bytes = max_bytes
+        ## Size of the texts not linked from anywhere as far as this
+        ## process knows, None until it is first needed; gc only walks
+        ## the store when it goes over the maximum.
+        self.size = None
+        self.lock = threading.Lock()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + '.txt')
+
+    def get(self, digest):
+        """Path of the text stored for digest, or None.  It is marked
+        as recently used.
+        """
+        path = self.path(digest)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        ## The access time tells how recently it was used; the
+        ## modification time is left alone, shadows are checked
+        ## against it.
+        try:
+            os.utime(path, (time.time(), st.st_mtime))
+        except OSError:
+            pass
+        return path
+
+    def put(self, digest, convert):
+        """Stores the text for digest produced by convert, a function
+        that writes it to the file it is given and returns whether it
+        succeeded.  Returns the path of the text, or None.
+        """
+        path = self.path(digest)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        ## Not .txt, so that gc leaves it alone while it is written.
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+        os.close(fd)
+        try:
+            if not convert(tmp) or not os.path.exists(tmp):
+                return None
+            os.rename(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(e[1] for e in self.entries() if e[2] == 1)
+            else:
+                self.size += os.path.getsize(path)
+            over = self.size > self.max_bytes
+        if over:
+            self.gc(keep=path)
+        return path
+
+    def link(self, digest, fname):
+        """Makes fname the text stored for digest.  Returns False if
+        there is none.
+        """
+        path = self.get(digest)
+        if path is None:
+            return False
+        if os.path.exists(fname):
+            os.remove(fname)
+        try:
+            st = os.stat(path)
+            os.link(path, fname)
+        except OSError:
+            shutil.copy2(path, fname)
+            return True
+        if st.st_nlink == 1:
+            with self.lock:
+                if self.size is not None:
+                    self.size = max(0, self.size - st.st_size)
+        return True
+
+    def entries(self):
+        """(path, size, number of links, last used) of each stored text,
+        least recently used first.
+        """
+        entries = []
+        if not os.path.exists(self.root):
+            return entries
+        for dirpath, dirnames, fnames in os.walk(self.root):
+            for fname in fnames:
+                if not fname.endswith('.txt'):
+                    continue
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_atime, path, st.st_size, st.st_nlink))
+        return [(path, size, nlink, used)
+                for used, path, size, nlink in sorted(entries)]
+
+    def gc(self, max_bytes=None, keep=None):
+        """Removes the least recently used texts that are not linked
+        from anywhere, other than keep, until they take at most
+        max_bytes (by default, the maximum size of the store).  Returns
+        how many were removed.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = [e for e in self.entries() if e[2] == 1]
+        size = sum(e[1] for e in entries)
+        removed = 0
+        for path, entry_size, nlink, used in entries:
+            if size <= max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            removed += 1
+        with self.lock:
+            self.size = size
+        return removed
+
+    def text_for(self, book_file, txt_file, convert):
+        """Makes txt_file the text version of book_file, converting it
+        with convert(book_file, txt) only if it is not in the store.
+        Returns whether it succeeded.
+        """
+        digest = content_hash(book_file)
+        if self.link(digest, txt_file):
+            return True
+        if self.put(digest, lambda txt: convert(book_file, txt)) is None:
+            return False
+        return self.link(digest, txt_file)
+
+
+_shared = {}
+
+def shared_store(max_mb=DEFAULT_MAX_MB):
+    """The store in the cache directory, shared by everybody in the
+    process.
+    """
+    root = os.path.join(cache_dir(), 'text')
+    key = (root, max_mb)
+    if key not in _shared:
+        _shared[key] = TextStore(root, max_mb << 20)
+    return _shared[key]
+
+
+def as_main():
+    import sys
+    def help():
+        print __doc__ % (__author__, __date__, DEFAULT_MAX_MB)
+
+    from getopt import getopt
+    opts, args = getopt(sys.argv[1:], 'hgs:', ['help', 'gc', 'size='])
+    gc = False
+    max_mb = DEFAULT_MAX_MB
+    for (opt, val) in opts:
+        if   opt == '-h' or opt == '--help':
+            help()
+            sys.exit(1)
+        elif opt == '-g' or opt == '--gc':
+            gc = True
+        elif opt == '-s' or opt == '--size':
+            max_mb = int(val)
+
+    store = shared_store(max_mb)
+    if gc:
+        print 'Removed', store.gc(), 'texts'
+    entries = store.entries()
+    print '%d texts, %.1f MB, %d not linked from anywhere' % \
+          (len(entries), sum(e[1] for e in entries) / float(1 << 20),
+           len([e for e in entries if e[2] == 1]))
+
+if __name__ == '__main__':
+    as_main()
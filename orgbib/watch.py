@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Wait for files to change, and tell when they have stopped changing.
+
+On Linux the directories are watched with inotify (through ctypes,
+there is nothing to install), so that a change is noticed as soon as
+it happens; elsewhere, or if inotify cannot be used, the waiting is
+just sleeping and whoever waits looks at the files again afterwards.
+Either way the files are then compared by their size and modification
+time, so that a directory that cannot be watched (a Kindle that is not
+mounted yet) is still looked at every time the wait times out.
+
+A file that is still being written keeps changing: Settler only
+reports a file once its size and modification time have not changed
+for a while.
+"""
+
+import os
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+
+from orgbib.store import file_signature
+
+## From <sys/inotify.h>.
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+
+_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+         IN_CREATE | IN_DELETE)
+
+
+class Inotify(object):
+    """Watches dirs with inotify.  Raises OSError if it cannot watch
+    any of them.
+    """
+    def __init__(self, dirs):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'No inotify')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watched = [d for d in dirs if os.path.isdir(d) and
+                        libc.inotify_add_watch(self.fd, d, _MASK) >= 0]
+        if not self.watched:
+            self.close()
+            raise OSError(errno.ENOENT, 'Nothing to watch')
+
+    def wait(self, timeout):
+        """Waits until something changes in the watched directories, or
+        for timeout seconds.  Returns whether something changed.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        ## The events only say that it is time to look; drain them.
+        try:
+            while os.read(self.fd, 1 << 16):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class Poller(object):
+    watched = []
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+def watcher(dirs, poll=False):
+    """An Inotify watching dirs if possible, unless poll is set, a
+    Poller otherwise.
+    """
+    if not poll:
+        try:
+            return Inotify(dirs)
+        except (OSError, AttributeError, TypeError):
+            pass
+    return Poller()
+
+
+class Settler(object):
+    """Tells which files have not changed for settle seconds since they
+    appeared or last changed.  Each version of a file is reported only
+    once.
+
+    >>> now = [0]
+    >>> settler = Settler(2, clock=lambda: now[0])
+    >>> settler.signature = lambda path: sizes.get(path)
+    >>> sizes = {'a': 1}
+    >>> settler.ready(['a'])
+    []
+    >>> now[0] = 1; sizes['a'] = 2
+    >>> settler.ready(['a']), settler.pending()
+    ([], True)
+    >>> now[0] = 3
+    >>> settler.ready(['a'])
+    ['a']
+    >>> now[0] = 10
+    >>> settler.ready(['a']), settler.pending()
+    ([], False)
+    """
+    def __init__(self, settle=2.0, clock=time.time):
+        self.settle = settle
+        self.clock = clock
+        self.signature = file_signature
+        ## Signature of each changing file and since when it has it.
+        self.changing = {}
+        ## Signature of each file when it was reported.
+        self.reported = {}
+
+    def ready(self, paths):
+        now = self.clock()
+        ready = []
+        for path in set(self.changing) - set(paths):
+            del self.changing[path]
+        for path in paths:
+            signature = self.signature(path)
+            if signature is None or self.reported.get(path) == signature:
+                self.changing.pop(path, None)
+                continue
+            seen = self.changing.get(path)
+            if seen is None or seen[0] != signature:
+                self.changing[path] = (signature, now)
+            elif now - seen[1] >= self.settle:
+                del self.changing[path]
+                self.reported[path] = signature
+                ready.append(path)
+        return ready
+
+    def pending(self):
+        """Whether some file is waiting to settle.
+        """
+        return bool(self.changing)
@@ -14,5 +14,6 @@ setup(name='orgbib',
                                 'azwclean = orgbib.cleanup:as_main',
                                 'docmeta = orgbib.docmeta:as_main',
                                 'docbib = orgbib.docid:as_main',
-                                'bookclips = orgbib.clipper:as_main']},
+                                'bookclips = orgbib.clipper:as_main',
+                                'booktexts = orgbib.textstore:as_main']},
       test_suite='orgbib.test.orgbib_test.suite')